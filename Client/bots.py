@@ -0,0 +1,322 @@
+"""
+Headless bot swarm for load testing. Each bot logs in through the gateway
+like a real client, acknowledges the frames it gets and drives the server
+with scripted input, without needing pygame or OpenGL.
+
+	python bots.py 500 --pattern mixed --duration 60 --processes 4
+
+Patterns:
+	wander	fly forward, turning now and then
+	fire	wander while firing
+	hop		steer for the nearest wormhole mouth and go through it
+	mixed	a random pattern per bot
+"""
+import time
+import math
+import random
+import socket
+import argparse
+import collections
+import multiprocessing
+
+import yaml
+import gevent
+
+import network
+import protocol
+from protocol import MSG, INPUTS
+
+BOT_TICK = 0.1 # seconds between bot decisions
+PATTERNS = ('wander', 'fire', 'hop')
+INTERACTION_RANGE = 40 # how close a hopping bot gets to a mouth before interacting
+TURN_CHANCE = 0.1 # chance per tick of a wandering bot changing how it's turning
+
+class RunningStats:
+	"""Count, mean and standard deviation of a series without keeping it."""
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.squares = 0.0 # sum of squared differences from the mean
+
+	def add(self, value):
+		self.count += 1
+		difference = value - self.mean
+		self.mean += difference / self.count
+		self.squares += difference * (value - self.mean)
+
+	def stddev(self):
+		return math.sqrt(self.squares / self.count) if self.count > 1 else 0.0
+
+
+class Bot:
+	def __init__(self, username, password, pattern, address=protocol.CLIENT_GATEWAY_ADDRESS):
+		self.username = username
+		self.password = password
+		self.pattern = pattern
+		self.address = address
+		self.sock = None
+		self.player_id = -1
+		self.keys = [False] * len(INPUTS.reverse_mapping)
+		self.turning = None # key a wandering bot is holding down to turn
+		# what the bot knows about the game
+		self.quantizer = None
+		self.wormholes = [] # (distance, speed, degree) of each mouth
+		self.system_received = None # when the system info arrived
+		self.position = None # (x, y, direction)
+		self.snapshots = {} # snapshot id: player rows
+		self.snapshot_ids = collections.deque()
+		# metrics
+		self.error = None
+		self.login_latency = None
+		self.connected = None
+		self.disconnected = None
+		self.last_frame = None
+		self.frames = 0
+		self.frame_intervals = RunningStats()
+		self.hops = 0
+
+	def run(self, duration, register=False):
+		try:
+			if not self.login(register):
+				return
+			receiver = gevent.spawn(self.receive)
+			end = time.time() + duration
+			while time.time() < end and not receiver.ready():
+				self.think()
+				gevent.sleep(BOT_TICK)
+			if not receiver.ready():
+				self.sock.send_message(MSG.CL_GW_LOGOUT)
+				receiver.kill()
+			self.disconnected = time.time()
+			self.sock.close()
+		except socket.error as e:
+			self.error = str(e)
+
+	def login(self, register):
+		self.sock = network.Socket()
+		self.sock.connect(self.address)
+		if register:
+			# failing to register just means the bot already has an account
+			self.sock.send_message(MSG.CL_GW_REGISTER, [self.username, self.password])
+			response = self.sock.wait_for_message([MSG.GW_CL_REGISTRATION_SUCCESSFUL,
+												   MSG.GW_CL_REGISTRATION_FAILED])
+			if response is None:
+				self.error = "gateway closed connection"
+				return False
+		start = time.time()
+		self.sock.send_message(MSG.CL_GW_LOGIN, [self.username, self.password])
+		response = self.sock.wait_for_message([MSG.GW_CL_LOGIN_FAILED,
+											   MSG.GW_CL_LOGIN_SUCCESSFUL])
+		if response is None:
+			self.error = "gateway closed connection"
+			return False
+		if response.type == MSG.GW_CL_LOGIN_FAILED:
+			self.error = "login failed"
+			return False
+		self.connected = time.time()
+		self.login_latency = self.connected - start
+		self.player_id = response.data
+		return True
+
+	def receive(self):
+		try:
+			while True:
+				msg = self.sock.wait_for_message()
+				if msg is None:
+					self.error = "server closed connection"
+					return
+				if msg.type == MSG.GW_CL_SYSTEM_INFO:
+					self.on_system_info(msg.data)
+				elif msg.type == MSG.GW_CL_MOVING_SYSTEMS:
+					self.hops += 1
+				elif msg.type == MSG.GW_CL_FRAME:
+					self.on_server_frame(msg.data)
+		except socket.error as e:
+			self.error = str(e)
+
+	def on_system_info(self, data):
+		system_data = yaml.load(data)
+		self.system_received = time.time()
+		self.wormholes = [(wormhole['distance'], wormhole['speed'], wormhole['degree'])
+						  for wormhole in system_data['wormholes']]
+		quantization = system_data.get('quantization')
+		self.quantizer = network.Quantizer(**quantization) if quantization else None
+		x, y = system_data['player']['position']
+		self.position = (x, y, 0)
+		self.snapshots = {}
+		self.snapshot_ids = collections.deque()
+
+	def on_server_frame(self, data):
+		now = time.time()
+		if self.last_frame is not None:
+			self.frame_intervals.add(now - self.last_frame)
+		self.last_frame = now
+		self.frames += 1
+		snapshot_id, baseline_id, changed_players, removed_players = data[:4]
+		if baseline_id != -1 and baseline_id not in self.snapshots:
+			return # we no longer have the snapshot this frame is relative to
+		player_rows = network.apply_delta_rows(self.snapshots.get(baseline_id),
+											   changed_players, removed_players)
+		self.snapshots[snapshot_id] = player_rows
+		self.snapshot_ids.append(snapshot_id)
+		if len(self.snapshot_ids) > protocol.SNAPSHOT_HISTORY:
+			del self.snapshots[self.snapshot_ids.popleft()]
+		self.sock.send_message(MSG.CL_GW_FRAME_ACK, snapshot_id)
+		row = player_rows.get(self.player_id)
+		if row is not None:
+			x, y, direction = row[:3]
+			if self.quantizer is not None:
+				q = self.quantizer
+				x, y, direction = q.unposition(x), q.unposition(y), q.unangle(direction)
+			self.position = (x, y, direction)
+
+	def press(self, key, state):
+		if self.keys[key] != state:
+			self.keys[key] = state
+			self.sock.send_message(MSG.CL_GW_INPUT, [key, 1 if state else 0])
+
+	def think(self):
+		if self.position is None:
+			return
+		if self.pattern == 'hop' and self.wormholes:
+			self.steer_towards(self.nearest_wormhole())
+			return
+		self.press(INPUTS.FORWARD, True)
+		self.press(INPUTS.FIRE, self.pattern == 'fire')
+		if random.random() < TURN_CHANCE:
+			self.turning = random.choice([None, INPUTS.LEFT, INPUTS.RIGHT])
+		self.press(INPUTS.LEFT, self.turning == INPUTS.LEFT)
+		self.press(INPUTS.RIGHT, self.turning == INPUTS.RIGHT)
+
+	def nearest_wormhole(self):
+		"""Where the closest wormhole mouth is now, going by its orbit."""
+		x, y, direction = self.position
+		elapsed = time.time() - self.system_received
+		mouths = []
+		for distance, speed, degree in self.wormholes:
+			degree += speed * elapsed
+			mouths.append((math.sin(degree)*distance, math.cos(degree)*distance))
+		return min(mouths, key=lambda (mx, my): (mx-x)**2 + (my-y)**2)
+
+	def steer_towards(self, target):
+		x, y, direction = self.position
+		target_x, target_y = target
+		# angle to turn through, between -pi and pi
+		turn = (math.atan2(target_x-x, target_y-y) - direction + math.pi) % protocol.MAX_RAD - math.pi
+		self.press(INPUTS.LEFT, turn < -0.1)
+		self.press(INPUTS.RIGHT, turn > 0.1)
+		self.press(INPUTS.FORWARD, abs(turn) < math.pi/2)
+		self.press(INPUTS.INTERACT, math.hypot(target_x-x, target_y-y) < INTERACTION_RANGE)
+
+	def metrics(self):
+		elapsed = (self.disconnected or time.time()) - self.connected if self.connected else 0
+		return {'username': self.username,
+				'pattern': self.pattern,
+				'error': self.error,
+				'login_latency': self.login_latency,
+				'frames': self.frames,
+				'frame_interval': self.frame_intervals.mean,
+				'frame_jitter': self.frame_intervals.stddev(),
+				'bytes_per_second': self.sock.buffer.received / elapsed if elapsed else 0,
+				'hops': self.hops}
+
+
+def run_bots(args, first, count):
+	"""Run count bots as greenlets, starting them evenly over args.ramp
+	seconds, and return their metrics.
+
+	"""
+	bots = []
+	greenlets = []
+	for i in xrange(count):
+		pattern = args.pattern if args.pattern != 'mixed' else random.choice(PATTERNS)
+		bot = Bot('%s%i' % (args.prefix, first+i), args.password, pattern, args.gateway)
+		bots.append(bot)
+		greenlets.append(gevent.spawn_later(args.ramp*i/count, bot.run, args.duration,
+											args.register))
+	gevent.joinall(greenlets)
+	return [bot.metrics() for bot in bots]
+
+def run_process(args, first, count, results):
+	gevent.reinit()
+	results.put(run_bots(args, first, count))
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values)-1, int(fraction*len(values)))]
+
+def summarise(metrics):
+	"""Reduce per-bot metrics to a report."""
+	connected = [m for m in metrics if m['login_latency'] is not None]
+	latencies = [m['login_latency'] for m in connected]
+	jitters = [m['frame_jitter'] for m in connected if m['frames'] > 1]
+	rates = [m['bytes_per_second'] for m in connected]
+	errors = collections.Counter(m['error'] for m in metrics if m['error'] is not None)
+	return {'bots': len(metrics),
+			'connected': len(connected),
+			'errors': dict(errors),
+			'frames': sum(m['frames'] for m in metrics),
+			'hops': sum(m['hops'] for m in metrics),
+			'login_latency': {'mean': sum(latencies)/len(latencies) if latencies else None,
+							  'p50': percentile(latencies, 0.5),
+							  'p99': percentile(latencies, 0.99)},
+			'frame_jitter': {'mean': sum(jitters)/len(jitters) if jitters else None,
+							 'p99': percentile(jitters, 0.99)},
+			'bytes_per_second': {'mean': sum(rates)/len(rates) if rates else None,
+								 'max': max(rates) if rates else None}}
+
+def parse_address(address):
+	host, port = address.rsplit(':', 1)
+	return (host, int(port))
+
+"""
+Start the bots up
+"""
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Headless bot swarm')
+	parser.add_argument('count', metavar='count', type=int,
+		help='Number of bots')
+	parser.add_argument('--pattern', choices=PATTERNS + ('mixed',), default='mixed',
+		help='How the bots play')
+	parser.add_argument('--duration', type=float, default=60.0,
+		help='Seconds each bot stays logged in')
+	parser.add_argument('--ramp', type=float, default=10.0,
+		help='Seconds over which to start the bots')
+	parser.add_argument('--processes', type=int, default=1,
+		help='Number of processes to share the bots between')
+	parser.add_argument('--prefix', default='bot',
+		help='Bot usernames are the prefix followed by a number')
+	parser.add_argument('--password', default='bot')
+	parser.add_argument('--register', action='store_true',
+		help='Register the bots before logging in')
+	parser.add_argument('--gateway', type=parse_address, default=protocol.CLIENT_GATEWAY_ADDRESS,
+		help='Gateway address as host:port')
+	parser.add_argument('--report', default=None,
+		help='File to write the report to as YAML')
+	args = parser.parse_args()
+
+	if args.processes > 1:
+		# fork before any greenlets exist
+		results = multiprocessing.Queue()
+		processes = []
+		for i in xrange(args.processes):
+			first = args.count * i / args.processes
+			count = args.count * (i+1) / args.processes - first
+			process = multiprocessing.Process(target=run_process, args=(args, first, count, results))
+			process.start()
+			processes.append(process)
+		metrics = []
+		for process in processes:
+			metrics.extend(results.get())
+		for process in processes:
+			process.join()
+	else:
+		metrics = run_bots(args, 0, args.count)
+	report = summarise(metrics)
+	print yaml.dump(report, default_flow_style=False)
+	if args.report is not None:
+		with open(args.report, 'w') as f:
+			f.write(yaml.dump(report, default_flow_style=False))
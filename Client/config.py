@@ -8,6 +8,7 @@ except ImportError:
 	print "Font module unavailable."
 
 import utility
+from protocol import * # networking constants and message types
 
 # window attributes
 SCREEN_WIDTH, SCREEN_HEIGHT = (1024, 960)
@@ -16,9 +17,6 @@ BACKGROUND_COLOUR = utility.Colour(0x05070F00)
 FRAMES_PER_SECOND = 60
 FRAME_RATE = 1.0/FRAMES_PER_SECOND
 
-# utility constants
-MAX_RAD = math.radians(360)
-
 # UI
 FONT = pygame.font.Font('Hattori_Hanzo.otf', 24)
 FONT_SMALL = pygame.font.Font('Hattori_Hanzo.otf', 16)
@@ -52,33 +50,4 @@ VALID_KEYS = frozenset([KEY_FORWARD, # TODO: this doesn't take into account pref
 						KEY_FIRE, 
 						KEY_INTERACT])
 
-CLIENT_GATEWAY_ADDRESS = ("127.0.0.1", 31000)
-
-# network values
-SOCKET_RECV_MAX_BYTES = 4096
-
-MSG_END_CHAR = chr(1)
-MSG_TOP_DELIMITER = 2
-NEGATIVE_CHAR = 126
-
-MSG_TIME_ACCURACY = 3 # how many digits after decimal point
-
 MINIMUM_DISTANCE = 40
-
-# Message types
-# Type ID format: '[SENDER]_[RECEIVER]_[DESCRIPTION]'
-class MSG:
-	OK = 0
-	# CLIENT to GATEWAY	
-	CL_GW_LOGIN = 1
-	CL_GW_LOGOUT = 2	
-	CL_GW_INPUT = 5
-	CL_GW_REGISTER = 7
-	# GATEWAY to CLIENT
-	GW_CL_LOGIN_SUCCESSFUL = 3
-	GW_CL_LOGIN_FAILED = 4
-	GW_CL_FRAME = 6
-	GW_CL_REGISTRATION_SUCCESSFUL = 8
-	GW_CL_REGISTRATION_FAILED = 9
-	GW_CL_MOVING_SYSTEMS = 10
-	GW_CL_SYSTEM_INFO = 11
\ No newline at end of file
@@ -1,4 +1,5 @@
 import math
+import collections
 
 import yaml
 import pygame
@@ -42,6 +43,9 @@ class Game:
 		self.server_sock = None
 
 		self.last_server_frame = None
+		self.snapshots = {} # snapshot id: (player rows, projectile rows)
+		self.snapshot_ids = collections.deque()
+		self.quantizer = None # set if the server quantizes frame positions
 
 		self.keys = None
 		self.init_key_config()
@@ -166,6 +170,10 @@ class Game:
 		self.ships = []
 		self.players = []
 		self.projectiles = []
+		self.snapshots = {}
+		self.snapshot_ids = collections.deque()
+		quantization = system_data.get('quantization')
+		self.quantizer = network.Quantizer(**quantization) if quantization else None
 
 		# player position
 		player = system_data['player']
@@ -201,44 +209,59 @@ class Game:
 	def loading_screen(self, system_name):
 		self.loading = True
 
+	def on_player_enter(self, player_id, row):
+		print "new player"
+		self.players.append(Player(projectile_pool=self.projectiles,
+								   colour=utility.Colour(config.ENEMY_COLOUR).to_rgba_f(), 
+								   player_id=player_id, name=row[6]))
+
+	def on_player_leave(self, player_id):
+		self.players = [player for player in self.players if player.id != player_id]
+
 	def on_server_frame(self, time, data):
+		snapshot_id, baseline_id, player_changes, removed_players, projectile_changes, removed_projectiles = data
+		if baseline_id != -1 and baseline_id not in self.snapshots:
+			return # we no longer have the snapshot this frame is relative to
 		if self.last_server_frame is None or time > self.last_server_frame:
 			self.last_server_frame = time
-			players, projectiles, new_players = data
-			# new players
-			if new_players and new_players != [None]:
-				print "new player"
-				for player_id, name in new_players:
-					if player_id != self.player_id:
-						self.players.append(Player(projectile_pool=self.projectiles,
-												   colour=utility.Colour(config.ENEMY_COLOUR).to_rgba_f(), 
-												   player_id=player_id, name=name))
+			baseline_players, baseline_projectiles = self.snapshots.get(baseline_id, (None, None))
+			player_rows = network.apply_delta_rows(baseline_players, player_changes, removed_players)
+			projectile_rows = network.apply_delta_rows(baseline_projectiles, projectile_changes, 
+													   removed_projectiles)
+			self.store_snapshot(snapshot_id, player_rows, projectile_rows)
+			self.server_sock.send_message(MSG.CL_GW_FRAME_ACK, snapshot_id)
+			# players entering and leaving our area of interest
+			known_players = set(player.id for player in self.players)
+			for player_id in set(player_rows) - known_players - set([self.player_id]):
+				self.on_player_enter(player_id, player_rows[player_id])
+			for player_id in known_players - set(player_rows):
+				self.on_player_leave(player_id)
 			# players
-			players_by_id = {pl_id: (pl_x, pl_y, pl_direction, pl_inputs, pl_destroyed, pl_respawn_in)
-							 for pl_id, pl_x, pl_y, pl_direction, pl_inputs, pl_destroyed, pl_respawn_in
-							 in players}
 			for player in self.players:
-				player.x, player.y, player.direction, player.inputs, player.destroyed, player.respawn_in = players_by_id[player.id]
+				x, y, direction, inputs, player.destroyed, player.respawn_in, name = player_rows[player.id]
+				player.inputs = [bool(inputs & (1 << key)) for key in range(5)] # sent as a bitmask
+				player.x, player.y, player.direction = self.from_frame(x, y, direction)
 			# projectiles
-			if projectiles and projectiles != [None]:
-				projectiles_by_id = {pr_id: (pr_x, pr_y, pr_direction, pr_player)
-									 for pr_id, pr_x, pr_y, pr_direction, pr_player
-									 in projectiles}
-				for projectile in self.projectiles:
-					if projectile.id not in projectiles_by_id:
-						self.projectiles.remove(projectile)
-					else:
-						x, y, projectile.direction, player_id = projectiles_by_id[projectile.id]
-						projectile.set_position(x, y)
-						del projectiles_by_id[projectile.id]
-				for pr_id, pr in projectiles_by_id.iteritems():
+			projectiles = []
+			for projectile in self.projectiles:
+				if projectile.id in projectile_rows:
+					x, y, direction, player_id = projectile_rows[projectile.id]
+					x, y, projectile.direction = self.from_frame(x, y, direction)
+					projectile.set_position(x, y)
+					projectiles.append(projectile)
+			known_projectiles = set(projectile.id for projectile in projectiles)
+			for pr_id, pr in projectile_rows.iteritems():
+				if pr_id not in known_projectiles:
 					x, y, direction, player_id = pr
+					x, y, direction = self.from_frame(x, y, direction)
 					projectile = Projectile(pr_id, (x, y), config.PROJECTILE_SPEED, direction,
 											utility.Colour(config.ENEMY_COLOUR if player_id != self.player_id else config.PLAYER_COLOUR).to_rgba_f())
 					projectile.set_position(x, y)
-					self.projectiles.append(projectile)
+					projectiles.append(projectile)
+			self.projectiles[:] = projectiles # players share this list as their projectile pool
 			# this player
-			my_x, my_y, my_direction, my_inputs, my_destroyed, my_respawning_in = players_by_id[self.player_id]
+			my_x, my_y, my_direction, my_inputs, my_destroyed, my_respawning_in, my_name = player_rows[self.player_id]
+			my_x, my_y, my_direction = self.from_frame(my_x, my_y, my_direction)
 			if my_destroyed and not self.player.destroyed:
 				self.player.destroy(my_respawning_in)
 				for planet in self.planets:
@@ -249,6 +272,20 @@ class Game:
 			self.player.set_position(my_x, my_y)
 			self.player.direction = my_direction
 
+	def from_frame(self, x, y, direction):
+		"""Convert a position and direction from a frame row to world units."""
+		if self.quantizer is None:
+			return x, y, direction
+		q = self.quantizer
+		return q.unposition(x), q.unposition(y), q.unangle(direction)
+
+	def store_snapshot(self, snapshot_id, player_rows, projectile_rows):
+		"""Keep a decoded frame so later frames can be applied on top of it."""
+		self.snapshots[snapshot_id] = (player_rows, projectile_rows)
+		self.snapshot_ids.append(snapshot_id)
+		if len(self.snapshot_ids) > config.SNAPSHOT_HISTORY:
+			del self.snapshots[self.snapshot_ids.popleft()]
+
 	def on_key(self, key, state):
 		if key in config.VALID_KEYS: # only act on valid keys
 			self.player.set_input(self.keys[key], state)
@@ -0,0 +1,58 @@
+"""
+Networking constants and message types shared by everything that talks to
+the gateway. Kept apart from config so that network.py, and headless tools
+like bots.py, don't need pygame or OpenGL.
+"""
+import math
+import os
+
+# enum function taken from: http://stackoverflow.com/a/1695250
+def enum(*sequential, **named):
+	enums = dict(zip(sequential, range(len(sequential))), **named)
+	reverse = dict((value, key) for key, value in enums.iteritems())
+	enums['reverse_mapping'] = reverse
+	return type('Enum', (), enums)
+
+MAX_RAD = math.radians(360)
+
+# the gateway listens for clients 1000 above GAME_PORT_BASE, see the server's config
+CLIENT_GATEWAY_ADDRESS = ("127.0.0.1", int(os.environ.get('GAME_PORT_BASE', 30000))+1000)
+
+# network values
+SOCKET_RECV_MAX_BYTES = 4096
+SOCKET_MAX_PENDING_MESSAGES = 256 # messages kept aside per socket while waiting for another type
+
+MSG_END_CHAR = chr(1)
+MSG_TOP_DELIMITER = 2
+NEGATIVE_CHAR = 126
+MSG_BINARY_CHAR = chr(0) # starts a length-prefixed binary message
+
+# wire codecs; sockets accept both, but send using MSG_CODEC unless told otherwise
+CODEC = enum('TEXT', 'BINARY')
+MSG_CODEC = CODEC.TEXT
+
+MSG_TIME_ACCURACY = 3 # how many digits after decimal point
+
+SNAPSHOT_HISTORY = 32 # frame snapshots kept to act as delta baselines
+
+# input keys as the server numbers them
+INPUTS = enum('FORWARD', 'LEFT', 'RIGHT', 'FIRE', 'INTERACT')
+
+# Message types
+# Type ID format: '[SENDER]_[RECEIVER]_[DESCRIPTION]'
+class MSG:
+	OK = 0
+	# CLIENT to GATEWAY	
+	CL_GW_LOGIN = 1
+	CL_GW_LOGOUT = 2	
+	CL_GW_INPUT = 5
+	CL_GW_REGISTER = 7
+	CL_GW_FRAME_ACK = 24
+	# GATEWAY to CLIENT
+	GW_CL_LOGIN_SUCCESSFUL = 3
+	GW_CL_LOGIN_FAILED = 4
+	GW_CL_FRAME = 6
+	GW_CL_REGISTRATION_SUCCESSFUL = 8
+	GW_CL_REGISTRATION_FAILED = 9
+	GW_CL_MOVING_SYSTEMS = 10
+	GW_CL_SYSTEM_INFO = 11
@@ -0,0 +1,182 @@
+"""
+Runs a whole cluster on localhost for benchmarking: generates a galaxy
+into a fresh database, starts the database server, the gateway and the
+gameservers in the right order, logs a bot swarm in and writes the bots'
+numbers and the gameservers' stats to a YAML report. Run it from the
+Server directory.
+
+	python cluster.py --servers 2 --bots 200 --seed 1 --report run.yaml
+
+Each process' output goes to a log file in --workdir.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+import yaml
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Client')
+STARTUP_TIMEOUT = 60 # seconds to wait for each part of the cluster to come up
+# offsets from the port base, on top of the ones in config
+GAMESERVER_PORT_OFFSET = 4000 # each gameserver takes two ports from here
+STATS_PORT_OFFSET = 5000 # each gameserver takes 100 ports from here, for itself and its workers
+
+class Cluster:
+	def __init__(self, args):
+		self.args = args
+		self.processes = []
+		self.env = dict(os.environ,
+						GAME_PORT_BASE=str(args.port_base),
+						GAME_SERVER_COUNT=str(args.servers),
+						GAME_DATABASE=os.path.abspath(os.path.join(args.workdir, 'cluster.db')))
+
+	def log_path(self, name):
+		return os.path.join(self.args.workdir, name + '.log')
+
+	def start(self, name, script, *arguments, **options):
+		"""Start a python script with its output going to a log file."""
+		log = open(self.log_path(name), 'w')
+		process = subprocess.Popen([sys.executable, '-u', script] + [str(a) for a in arguments],
+								   stdout=log, stderr=subprocess.STDOUT, env=self.env,
+								   cwd=options.get('cwd'))
+		self.processes.append((name, process))
+		return process
+
+	def wait_for_output(self, name, marker):
+		"""Wait until a process has printed marker, or fail if it exits first."""
+		process = dict(self.processes)[name]
+		deadline = time.time() + STARTUP_TIMEOUT
+		while time.time() < deadline:
+			with open(self.log_path(name)) as log:
+				if marker in log.read():
+					return
+			if process.poll() is not None:
+				raise RuntimeError("%s exited during startup, see %s" % (name, self.log_path(name)))
+			time.sleep(0.2)
+		raise RuntimeError("%s didn't start in time, see %s" % (name, self.log_path(name)))
+
+	def gameserver_ports(self, i):
+		client_port = self.args.port_base + GAMESERVER_PORT_OFFSET + i*2
+		stats_port = self.args.port_base + STATS_PORT_OFFSET + i*100
+		return client_port, client_port+1, stats_port
+
+	def run(self):
+		args = self.args
+		started = time.time()
+		# generate the galaxy into a fresh database
+		if os.path.exists(self.env['GAME_DATABASE']):
+			os.remove(self.env['GAME_DATABASE'])
+		seed_arguments = ['--min-systems', args.systems, '--max-systems', args.systems]
+		if args.seed is not None:
+			seed_arguments += ['--seed', args.seed]
+		if self.start('worldinit', 'worldinit.py', *seed_arguments).wait() != 0:
+			raise RuntimeError("Generating the galaxy failed, see %s" % self.log_path('worldinit'))
+		# bring the servers up in order
+		self.start('database', 'database.py')
+		self.wait_for_output('database', "Accepting connections")
+		self.start('gateway', 'gateway.py')
+		self.wait_for_output('gateway', "Accepting server connections")
+		for i in xrange(args.servers):
+			client_port, server_port, stats_port = self.gameserver_ports(i)
+			self.start('gameserver%i' % i, 'gameserver.py', client_port, server_port,
+					   '--workers', args.workers, '--stats-port', stats_port)
+		self.wait_for_output('gateway', "Accepting client connections")
+		ready = time.time()
+		# run the bots
+		bot_report = os.path.abspath(os.path.join(args.workdir, 'bots.yaml'))
+		bots = self.start('bots', 'bots.py', args.bots, '--register', '--pattern', args.pattern,
+						  '--duration', args.duration, '--ramp', args.ramp,
+						  '--processes', args.bot_processes,
+						  '--gateway', '127.0.0.1:%i' % (args.port_base+1000),
+						  '--report', bot_report, cwd=CLIENT_DIR)
+		bots.wait()
+		with open(bot_report) as f:
+			bot_results = yaml.load(f.read())
+		return {'run': {'port_base': args.port_base,
+						'servers': args.servers,
+						'workers': args.workers,
+						'systems': args.systems,
+						'seed': args.seed,
+						'bots': args.bots,
+						'pattern': args.pattern,
+						'duration': args.duration,
+						'startup_time': ready - started},
+				'bots': bot_results,
+				'throughput': {'frames_per_second': bot_results['frames'] / float(args.duration)},
+				'gameservers': [self.gameserver_stats(i) for i in xrange(args.servers)]}
+
+	def gameserver_stats(self, i):
+		"""Fetch the stats of a gameserver, or of each of its workers."""
+		client_port, server_port, stats_port = self.gameserver_ports(i)
+		if self.args.workers:
+			ports = [stats_port + w + 1 for w in xrange(self.args.workers)]
+		else:
+			ports = [stats_port]
+		return [fetch_stats(port) for port in ports]
+
+	def stop(self):
+		for name, process in reversed(self.processes):
+			if process.poll() is None:
+				process.terminate()
+		for name, process in self.processes:
+			process.wait()
+
+def fetch_stats(port):
+	try:
+		sock = socket.create_connection(('127.0.0.1', port), 5)
+	except socket.error:
+		return None
+	data = []
+	while True:
+		chunk = sock.recv(4096)
+		if not chunk:
+			break
+		data.append(chunk)
+	sock.close()
+	return yaml.load(''.join(data))
+
+"""
+Start the cluster up
+"""
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Run a cluster and a bot swarm on localhost and report on it')
+	parser.add_argument('--port-base', type=int, default=40000,
+		help='Ports used are offset from this')
+	parser.add_argument('--servers', type=int, default=2,
+		help='Number of gameservers')
+	parser.add_argument('--workers', type=int, default=0,
+		help='Worker processes per gameserver')
+	parser.add_argument('--systems', type=int, default=60,
+		help='Number of solar systems to generate')
+	parser.add_argument('--seed', type=int, default=None,
+		help='Galaxy generation seed')
+	parser.add_argument('--bots', type=int, default=100)
+	parser.add_argument('--pattern', default='mixed',
+		help='Bot pattern, see bots.py')
+	parser.add_argument('--duration', type=float, default=60.0,
+		help='Seconds each bot stays logged in')
+	parser.add_argument('--ramp', type=float, default=10.0,
+		help='Seconds over which to start the bots')
+	parser.add_argument('--bot-processes', type=int, default=1)
+	parser.add_argument('--workdir', default='cluster',
+		help='Directory for the database, logs and bot report')
+	parser.add_argument('--report', default=None,
+		help='File to write the report to as YAML, otherwise it is printed')
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.workdir):
+		os.makedirs(args.workdir)
+	cluster = Cluster(args)
+	try:
+		report = cluster.run()
+	finally:
+		cluster.stop()
+	if args.report is not None:
+		with open(args.report, 'w') as f:
+			f.write(yaml.dump(report, default_flow_style=False))
+	else:
+		print yaml.dump(report, default_flow_style=False)
@@ -1,4 +1,5 @@
 import math
+import os
 
 from utility import enum
 
@@ -14,26 +15,38 @@ START_Y = 150
 """
 Networking
 """
+# ports are offset from GAME_PORT_BASE, so more than one cluster can run on a machine
+PORT_BASE = int(os.environ.get('GAME_PORT_BASE', 30000))
 # {FROM}_{TO}_ADDRESS = (ip, port)
-SERVER_GATEWAY_ADDRESS = ("127.0.0.1", 30000)
-CLIENT_GATEWAY_ADDRESS = ("127.0.0.1", 31000)
-GATEWAY_SERVER_ADDRESS = ("127.0.0.1", 32000)
-SERVER_DATABASE_ADDRESS = ("127.0.0.1", 33000)
+SERVER_GATEWAY_ADDRESS = ("127.0.0.1", PORT_BASE)
+CLIENT_GATEWAY_ADDRESS = ("127.0.0.1", PORT_BASE+1000)
+GATEWAY_SERVER_ADDRESS = ("127.0.0.1", PORT_BASE+2000)
+SERVER_DATABASE_ADDRESS = ("127.0.0.1", PORT_BASE+3000)
 
 # network values
 SOCKET_SERVER_MAX_QUEUE = 512
 SOCKET_CLIENT_MAX_QUEUE = 512
 SOCKET_DATABASE_MAX_QUEUE = 512
 SOCKET_RECV_MAX_BYTES = 4096
+SOCKET_MAX_PENDING_MESSAGES = 256 # messages kept aside per socket while waiting for another type
 
-GATEWAY_SERVER_COUNT = 2
+GATEWAY_SERVER_COUNT = int(os.environ.get('GAME_SERVER_COUNT', 2))
+
+DATABASE_FILE = os.environ.get('GAME_DATABASE', 'data.db')
 
 MSG_END_CHAR = chr(1)
 MSG_TOP_DELIMITER = 2
 NEGATIVE_CHAR = 126
+MSG_BINARY_CHAR = chr(0) # starts a length-prefixed binary message
+
+# wire codecs; sockets accept both, but send using MSG_CODEC unless told otherwise
+CODEC = enum('TEXT', 'BINARY')
+MSG_CODEC = CODEC.TEXT
 
 MSG_TIME_ACCURACY = 3 # how many digits after decimal point
 
+SNAPSHOT_HISTORY = 32 # frame snapshots kept to act as delta baselines
+
 # database query types
 DBQUERY = enum('GW_STARTINFO', 'GS_SYSTEMSINFO', 'GS_UPDATE', 'GW_NEWPLAYER')
 
@@ -46,6 +59,7 @@ class MSG:
 	CL_GW_LOGOUT = 2	
 	CL_GW_INPUT = 5
 	CL_GW_REGISTER = 7
+	CL_GW_FRAME_ACK = 24
 	# GATEWAY to CLIENT
 	GW_CL_LOGIN_SUCCESSFUL = 3
 	GW_CL_LOGIN_FAILED = 4
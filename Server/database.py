@@ -1,15 +1,40 @@
 import sqlite3
 import argparse
+import time
+import threading
 import os
+import collections
 
 import yaml
 import gevent
+from gevent.event import AsyncResult, Event
+from gevent.threadpool import ThreadPool
 
 import network
 import config
+import stats
 from config import MSG, DBQUERY
 from utility import enum
 
+STATS_ENABLED = True # record query timings, see stats.py
+STATS_DUMP_RATE = 10.0 # how often in seconds to write stats to --stats-file
+READ_THREADS = 4 # threads running read queries, each with its own connection
+# writes are committed in batches, once COMMIT_INTERVAL seconds have passed since the
+# first write in the batch or COMMIT_ROWS rows have changed, whichever comes first
+COMMIT_INTERVAL = 0.1
+COMMIT_ROWS = 1000
+SYNCHRONOUS = 'NORMAL' # sqlite's synchronous setting, with WAL NORMAL only risks the last batches
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+POSITIONS_QUERY_ID = 'positions' # id shared by GS_UPDATE queries, so only one is ever queued
+
+# query classes, each queued separately: interactive ones have someone waiting on them,
+# like registration, bootstrap ones are servers starting up and background ones are
+# position flushes. Classes share the queue in proportion to their weights
+QUERY_CLASS = enum('INTERACTIVE', 'BOOTSTRAP', 'BACKGROUND')
+QUERY_CLASS_WEIGHTS = {QUERY_CLASS.INTERACTIVE: 8,
+					   QUERY_CLASS.BOOTSTRAP: 2,
+					   QUERY_CLASS.BACKGROUND: 1}
+
 class InvalidQueryException(Exception):
 	def __init__(self, query):
 		self.query = query
@@ -18,32 +43,53 @@ class InvalidQueryException(Exception):
 		return repr(self.query) + ' is not a valid query.'
 
 class QueryQueue:
-	"""Queues database queries in a first-in-first-out fashion. Requires that
-	types of query be initialised using add_query_type, which links a callback
-	with each query type. When next_query() is called, the queue passes the
-	data for the oldest query to the relevant callback, then removes the query
-	from the queue. Queries that make use of the id parameter in add_query()
+	"""Queues database queries by class, first-in-first-out within a class.
+	Requires that types of query be initialised using add_query_type, which
+	links a callback and a class with each query type. When next_query() is
+	called, the queue picks a class by weighted fair queueing, so each class
+	with queries waiting gets a share of the turns in proportion to its
+	weight, then passes the data for that class' oldest query to the relevant
+	callback and removes the query from the queue. Queries that make use of
+	the id parameter in add_query()
 	are compared with previous queries of that type; if the id matches with an
-	older query, the older query is removed and replaced by the newer query.
+	older query, the older query is removed and replaced by the newer query,
+	whose result is passed on to the older query's waiters as well. Each
+	query's result is set when it has been processed, so whoever added it can
+	wait on it, and anything waiting for queries is woken when one is added.
 
 	"""
-	def __init__(self):
-		self.query_queue = []
+	def __init__(self, class_weights=QUERY_CLASS_WEIGHTS):
+		self.weights = class_weights
+		self.class_queues = dict((query_class, collections.deque())
+								 for query_class in class_weights)
+		# the virtual time at which each class is next due a turn; a class goes
+		# forward 1/weight each turn, and the lowest goes next
+		self.class_times = dict.fromkeys(class_weights, 0.0)
+		self.virtual_time = 0.0 # the time of the last class to have a turn
+		self.length = 0
 		self.queries = {}
 		self.callbacks = {}
+		self.query_classes = {}
+		self.not_empty = Event() # set while there are queries waiting
 
-	def add_query_type(self, type, callback):
+	def add_query_type(self, type, callback, query_class=QUERY_CLASS.BACKGROUND):
 		"""Link a callback with a query type. This should be done before adding
 		any queries of the specified type.
 
 		type -- the query type to be linked.
 		callback -- the callback to be run when a query with the matching type
 					is processed.
+		query_class -- (optional) the class the query type is queued in.
 
 		"""
 		self.callbacks[type] = callback
+		self.query_classes[type] = query_class
 		self.queries[type] = {}
 
+	def depth(self, query_class):
+		"""Return the number of queries of query_class waiting."""
+		return len(self.class_queues[query_class])
+
 	def add_query(self, query):
 		"""Add a query to the queue. If the id parameter is given, check whether
 		a query of the same type with the same id already exists and remove it
@@ -57,43 +103,112 @@ class QueryQueue:
 			  same type.
 
 		"""
-		if query.id is None:
-			self.query_queue.append(query)
-		elif self.queries[query.type] is not None:
-			if self.queries[query.type][query.id] is not None:
-				old_query = self.queries[query.type]
-				self.query_queue.remove(old_query)
+		query.query_class = self.query_classes[query.type]
+		class_queue = self.class_queues[query.query_class]
+		if query.id is not None:
+			old_query = self.queries[query.type].get(query.id)
+			if old_query is not None:
+				class_queue.remove(old_query)
+				self.length -= 1
+				query.replaced.append(old_query)
+				query.replaced.extend(old_query.replaced)
 			self.queries[query.type][query.id] = query
-			self.query_queue.append(query)
+		if not class_queue:
+			# a class doesn't save up turns while it has nothing queued
+			self.class_times[query.query_class] = max(self.class_times[query.query_class],
+													  self.virtual_time)
+		class_queue.append(query)
+		self.length += 1
+		self.not_empty.set()
+
+	def wait(self):
+		"""Block the calling greenlet until there's a query to process."""
+		self.not_empty.wait()
 
 	def next_query(self):
-		"""Process the next query and then remove it from the queue."""
-		if len(self.query_queue) > 0:
-			query = self.query_queue[0]
+		"""Process the next query and then remove it from the queue. Any
+		exception raised by the callback is passed on to whoever is waiting
+		for the result rather than raised here. Return the query processed, or
+		None if the queue was empty.
+
+		"""
+		if self.length == 0:
+			return None
+		query_class = min((query_class for query_class, class_queue in self.class_queues.iteritems()
+						   if class_queue),
+						  key=lambda query_class: (self.class_times[query_class], query_class))
+		self.virtual_time = self.class_times[query_class]
+		self.class_times[query_class] += 1.0 / self.weights[query_class]
+		query = self.class_queues[query_class].popleft()
+		self.length -= 1
+		if query.id is not None: del self.queries[query.type][query.id]
+		if self.length == 0:
+			self.not_empty.clear()
+		query.started = time.time()
+		try:
 			if query.data is not None:
-				query.result = self.callbacks[query.type](query.data)
+				result = self.callbacks[query.type](query.data)
 			else:
-				query.result = self.callbacks[query.type]()
-			self.query_queue.remove(query)
-			if query.id is not None: self.queries[query.type][query.id] = None
+				result = self.callbacks[query.type]()
+		except Exception as e:
+			for replaced_query in [query] + query.replaced:
+				replaced_query.result.set_exception(e)
+		else:
+			for replaced_query in [query] + query.replaced:
+				replaced_query.result.set(result)
+		query.finished = time.time()
+		return query
 
 class Query:
-	"""Query class used for passing query data and results between greenlets."""
+	"""Query class used for passing query data and results between greenlets.
+	result is an AsyncResult set once the query has been processed.
+
+	"""
 	def __init__(self, type, id=None, data=None):
 		self.type = type
 		self.id = id
 		self.data = data
-		self.result = None
-
-class Database:
+		self.result = AsyncResult()
+		self.replaced = [] # older queries with the same id this one replaced
+		self.query_class = None # set when queued
+		self.queued = time.time()
+		self.started = None
+		self.finished = None
+
+class WriteBatch:
+	"""Writes made since the last commit, to be committed together."""
 	def __init__(self):
-		db_exists = os.path.exists('data.db')
-
-		self.connection = sqlite3.connect('data.db')		
-		self.cursor = self.connection.cursor()
+		self.started = time.time()
+		self.writes = 0
+		self.rows = 0
+		self.full = Event() # set to commit the batch without waiting any longer
+		self.committed = AsyncResult()
+
+class Database(object):
+	"""Serves queries from the other servers. Sockets and the query queue
+	are handled by greenlets, while the SQL itself runs on thread pools so a
+	long query doesn't hold up the event loop: reads on READ_THREADS threads
+	and writes on a single writer thread. Every thread has its own sqlite
+	connection, which the connection and cursor properties return.
+
+	The database is in WAL mode, so reads don't block writes or the other way
+	round. Writes are group committed: they go into the open transaction
+	straight away and a WriteBatch commits them together a little later,
+	unless a write needs to be durable before it's answered.
 
-		# make sure TEXT outputs as a bytestring and not unicode
-		self.connection.text_factory = str
+	"""
+	def __init__(self, stats_file=None, stats_port=None, synchronous=SYNCHRONOUS):
+		self.stats = stats.Stats(STATS_ENABLED)
+		self.stats_file = stats_file # where to dump stats every STATS_DUMP_RATE seconds
+		self.stats_port = stats_port # local port to serve stats on
+		self.synchronous = synchronous
+		self.local = threading.local() # per-thread connection and cursor
+		self.readers = ThreadPool(READ_THREADS)
+		self.writer = ThreadPool(1)
+		self.batch = None # the WriteBatch writes are currently going into
+		self.positions = {} # player id: newest position row not yet written
+
+		db_exists = os.path.exists(config.DATABASE_FILE)
 
 		# check whether the database already exists, create it if it doesn't		
 		if not db_exists:
@@ -102,18 +217,113 @@ class Database:
 		# set up the query types in the query queue
 		self.query_queue = QueryQueue()
 		self.query_queue.add_query_type(DBQUERY.GS_SYSTEMSINFO, 
-										self.get_gameserver_data)
+										self.on_pool(self.readers, self.get_gameserver_data),
+										QUERY_CLASS.BOOTSTRAP)
 		self.query_queue.add_query_type(DBQUERY.GW_STARTINFO, 
-										self.get_gateway_data)
+										self.on_pool(self.readers, self.get_gateway_data),
+										QUERY_CLASS.BOOTSTRAP)
+		self.write_positions = self.on_writer(self.server_update)
 		self.query_queue.add_query_type(DBQUERY.GS_UPDATE, 
-										self.server_update)
+										self.flush_positions,
+										QUERY_CLASS.BACKGROUND)
 		self.query_queue.add_query_type(DBQUERY.GW_NEWPLAYER,
-										self.new_player)
+										self.on_writer(self.new_player, durable=True),
+										QUERY_CLASS.INTERACTIVE)
+
+	@property
+	def connection(self):
+		"""The calling thread's connection, opened on first use."""
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			connection = self.local.connection = sqlite3.connect(config.DATABASE_FILE)
+			# make sure TEXT outputs as a bytestring and not unicode
+			connection.text_factory = str
+			connection.execute('PRAGMA journal_mode=WAL;')
+			connection.execute('PRAGMA synchronous=%s;' % self.synchronous)
+			self.local.cursor = connection.cursor()
+		return connection
+
+	@property
+	def cursor(self):
+		self.connection
+		return self.local.cursor
+
+	def on_pool(self, pool, callback):
+		"""Wrap callback so that calling it runs it on one of pool's threads,
+		blocking only the calling greenlet until it's done.
+
+		"""
+		def run(*args):
+			return pool.apply(callback, args)
+		return run
+
+	def on_writer(self, callback, durable=False):
+		"""Wrap a write callback so that calling it runs it on the writer
+		thread, as part of the current batch. A durable write commits the
+		batch straight away and waits for the commit before returning, others
+		return once the write is in the open transaction.
+
+		"""
+		def run(*args):
+			batch = self.batch
+			if batch is None:
+				batch = self.batch = WriteBatch()
+				gevent.spawn(self.commit_batch, batch)
+			result, rows = self.writer.apply(self.run_write, (callback, args))
+			batch.writes += 1
+			batch.rows += rows
+			if durable or batch.rows >= COMMIT_ROWS:
+				batch.full.set()
+			if durable:
+				batch.committed.get()
+			return result
+		return run
+
+	def run_write(self, callback, args):
+		"""Run a write callback on the writer thread and return its result
+		and how many rows it changed.
+
+		"""
+		changes = self.connection.total_changes
+		result = callback(*args)
+		return result, self.connection.total_changes - changes
+
+	def commit_batch(self, batch):
+		"""Commit batch once it's full or COMMIT_INTERVAL has passed. Writes
+		queued on the writer thread before the commit are run first, so they
+		are part of it, and later ones go into a new batch.
+
+		"""
+		batch.full.wait(COMMIT_INTERVAL)
+		if self.batch is batch:
+			self.batch = None
+		start = time.time()
+		try:
+			self.writer.apply(self.commit)
+		except Exception as e:
+			print "Commit failed: %s" % e
+			batch.committed.set_exception(e)
+		else:
+			batch.committed.set(True)
+		finished = time.time()
+		self.stats.record('write.commit', finished - start)
+		self.stats.record('write.latency', finished - batch.started)
+		self.stats.record('write.batch_writes', batch.writes, stats.COUNT_BOUNDS)
+		self.stats.record('write.batch_rows', batch.rows, stats.COUNT_BOUNDS)
+
+	def commit(self):
+		self.connection.commit()
 
 	def begin(self):
-		processing_greenlet = gevent.spawn(self.process_queue)
+		# a greenlet per thread, so every thread can be kept busy
+		processing_greenlets = [gevent.spawn(self.process_queue)
+								for i in xrange(READ_THREADS+1)]
 		connect_greenlet = gevent.spawn(self.accept_connections)
-		gevent.joinall([processing_greenlet, connect_greenlet])
+		if self.stats.enabled and self.stats_file is not None:
+			gevent.spawn(self.dump_stats)
+		if self.stats.enabled and self.stats_port is not None:
+			gevent.spawn(self.stats.serve, self.stats_port)
+		gevent.joinall(processing_greenlets + [connect_greenlet])
 
 	def create_database(self):
 		print "Creating database from SQL dump"
@@ -123,9 +333,22 @@ class Database:
 
 	def process_queue(self):
 		while True:
-			self.query_queue.next_query()
+			self.query_queue.wait()
+			query = self.query_queue.next_query()
+			if query is not None:
+				name = DBQUERY.reverse_mapping[query.type]
+				self.stats.record('query.%s.wait' % name, query.started - query.queued)
+				self.stats.record('queue.%s.wait' % QUERY_CLASS.reverse_mapping[query.query_class],
+								  query.started - query.queued)
+				self.stats.record('query.%s.run' % name, query.finished - query.started)
+			# let the connections run between queries
 			gevent.sleep()
 
+	def dump_stats(self):
+		while True:
+			gevent.sleep(STATS_DUMP_RATE)
+			self.stats.dump(self.stats_file)
+
 	def accept_connections(self):
 		"""Callback for when a client connection is accepted. Starts an infinite
 		loop that receives data from the client, passes it to a handler, then
@@ -150,14 +373,24 @@ class Database:
 			if msg is None:
 				print "Connection from " + str(sock.address) + " closed"
 				break
-			response = self.handle_query(msg.data)
+			received = time.time()
+			try:
+				query_type, response = self.handle_query(msg.data)
+			except Exception as e:
+				# answer anyway, so whoever sent the query isn't left waiting
+				print "Query failed: %s" % e
+				self.stats.count('query.failed')
+				sock.send_message(MSG.DB_RESPONSE, [msg.id, None])
+				continue
 			sock.send_message(MSG.DB_RESPONSE, [msg.id, response])
+			self.stats.record('query.%s.latency' % DBQUERY.reverse_mapping[query_type],
+							  time.time() - received)
 
 	def handle_query(self, query):
 		"""Parses a query and passes the query data to the relevant method,
-		depending on the query type. Returns the result of the actual database
-		query. If it does not recognise the query type, it raises an
-		InvalidQueryException.
+		depending on the query type. Returns the query type and the result of
+		the actual database query, once the query queue has got to it. If it
+		does not recognise the query type, it raises an InvalidQueryException.
 
 		raw_query -- the raw query from the client
 
@@ -177,7 +410,10 @@ class Database:
 			query_object = Query(DBQUERY.GW_STARTINFO)
 		elif query_type == DBQUERY.GS_UPDATE: # update from gameserver
 			print "Update from server"
-			query_object = Query(DBQUERY.GS_UPDATE, None, data)
+			# only the newest position of each player is kept, and the queued
+			# query writes all of them
+			self.buffer_positions(data)
+			query_object = Query(DBQUERY.GS_UPDATE, POSITIONS_QUERY_ID)
 		elif query_type == DBQUERY.GW_NEWPLAYER:
 			username, password, solar_system, x, y = data
 			query_object = Query(DBQUERY.GW_NEWPLAYER, None, data)
@@ -185,10 +421,9 @@ class Database:
 			raise InvalidQueryException(query)
 
 		self.query_queue.add_query(query_object)
-
-		while query_object.result is None:
-			gevent.sleep()
-		return query_object.result
+		self.stats.record('queue.%s.depth' % QUERY_CLASS.reverse_mapping[query_object.query_class],
+						  self.query_queue.depth(query_object.query_class), stats.COUNT_BOUNDS)
+		return query_type, query_object.result.get()
 
 	# get the data necessary for a server at startup
 	# provided a list of solar systems the server contains
@@ -267,6 +502,22 @@ class Database:
 		player_data = self.cursor.fetchall()
 		return [solar_system_data, wormhole_data, player_data]
 
+	def buffer_positions(self, dirty_players):
+		"""Keep the newest position of each player until the next flush, so
+		however far the writes fall behind there's at most one row a player.
+
+		"""
+		for row in dirty_players:
+			if row[0] in self.positions:
+				self.stats.count('write.positions_coalesced')
+			self.positions[row[0]] = row
+
+	def flush_positions(self):
+		"""Write every buffered position and empty the buffer."""
+		dirty_players = self.positions.values()
+		self.positions = {}
+		return self.write_positions(dirty_players)
+
 	def server_update(self, dirty_players):
 		self.cursor.executemany('UPDATE player \
 								SET x_position=(?), y_position=(?), \
@@ -284,5 +535,18 @@ class Database:
 							 									 solar_system, x, y,))
 		return self.cursor.lastrowid
 
-database = Database()
-database.begin()
\ No newline at end of file
+"""
+Start the database up
+"""
+parser = argparse.ArgumentParser(
+	description='Database server')
+parser.add_argument('--stats-file', default=None, 
+	help='File to dump stats to periodically')
+parser.add_argument('--stats-port', type=int, default=None, 
+	help='Local port to serve stats on')
+parser.add_argument('--synchronous', choices=SYNCHRONOUS_LEVELS, default=SYNCHRONOUS, 
+	help='How hard sqlite tries to make commits survive a crash or power loss')
+args = parser.parse_args()
+
+database = Database(args.stats_file, args.stats_port, args.synchronous)
+database.begin()
@@ -1,24 +1,47 @@
 import time
 import math
 import argparse
-import random
+import collections
 
 import yaml
 import gevent
+import numpy
 
 import network
 import config
+import scheduler
+import workers
+import stats
 from config import DBQUERY, MSG
-from utility import enum, Rect
+from utility import enum, Rect, SpatialHash
 
 FRAME_RATE = 1.0/100 # length of a frame in seconds
+SNAPSHOT_RATE = 1.0/20 # how often in seconds to send frames to players
+PLAYER_SNAPSHOT_RATE = 0 # default per-player cap on how often a player gets frames, 0 for none
+# area of interest: entities within INTEREST_RADIUS of a player are in every frame they
+# get, ones within INTEREST_FAR_RADIUS are updated every FAR_SNAPSHOT_RATE seconds, and
+# anything further away is left out of their frames altogether
+INTEREST_RADIUS = 300
+INTEREST_FAR_RADIUS = 600
+FAR_SNAPSHOT_RATE = 1.0/4
+MAX_CATCH_UP_FRAMES = 5 # frames simulated in one go before dropping the backlog
+SCHEDULER_REPORT_RATE = 10.0 # how often in seconds to report overrunning ticks
+STATS_ENABLED = True # record tick, frame and database timings, see stats.py
+STATS_DUMP_RATE = 10.0 # how often in seconds to write stats to --stats-file
 DATABASE_FRAME_RATE = 4.0 # how often in seconds to commit to DB
 
+# frame positions and directions are sent as fixed-point ints when enabled
+QUANTIZE_FRAMES = True
+QUANTIZE_POSITION_BITS = 16
+QUANTIZE_POSITION_RANGE = 2.0 # encodable distance from the sun, as a multiple of system size
+QUANTIZE_ANGLE_STEPS = 4096 # directions per full turn
+
 PLAYER_SPEED = 100 # pixels/second
 PLAYER_TURN_SPEED = math.radians(180) # radians/second
 PLAYER_FIRE_RATE = 1.0/5 # per second
 
 WORMHOLE_SIZE = 30
+BROADPHASE_CELL_SIZE = 64 # should be at least as big as the largest planet or wormhole
 PROJECTILE_SIZE = 5
 INTERACTION_AREA = 100
 
@@ -33,33 +56,86 @@ class Client:
 		self.socket = client_socket
 		self.address = address
 		self.player = player
+		self.acked_snapshot = -1 # newest frame snapshot the client has confirmed
+		self.snapshot_interval = PLAYER_SNAPSHOT_RATE # minimum seconds between frames
+		self.next_snapshot = 0 # when the client's next frame is due
+		self.next_far_snapshot = 0 # when distant entities are next brought up to date
+		self.worker = None # Channel to the worker running the player's system, in worker mode
+		self.snapshots = {} # snapshot id: (player rows, projectile rows) as sent to this client
+		self.snapshot_ids = collections.deque()
+		self.view = ({}, {}) # player and projectile rows in the last frame sent
+
+	def reset_snapshots(self):
+		"""Forget the frames sent so far, so the next one is sent in full."""
+		self.acked_snapshot = -1
+		self.next_far_snapshot = 0
+		self.snapshots = {}
+		self.snapshot_ids = collections.deque()
+		self.view = ({}, {})
+
+	def store_snapshot(self, snapshot_id, player_rows, projectile_rows):
+		self.view = (player_rows, projectile_rows)
+		self.snapshots[snapshot_id] = self.view
+		self.snapshot_ids.append(snapshot_id)
+		if len(self.snapshot_ids) > config.SNAPSHOT_HISTORY:
+			del self.snapshots[self.snapshot_ids.popleft()]
 
 class OfflinePlayer:
-	def __init__(self, player_id, name, x, y, solar_system):
+	def __init__(self, player_id, name, x, y, solar_system, arrived_from=None):
 		self.id = player_id
 		self.name = name
 		self.x = x
 		self.y = y
 		self.solar_system = solar_system
+		self.arrived_from = arrived_from # id of the system they came from through a wormhole
+
+def player_field(name):
+	"""A Player attribute kept in its solar system's PlayerTable, or on the
+	player itself while it isn't in one.
+
+	"""
+	def get(self):
+		if self.table is None:
+			return self.detached[name]
+		return getattr(self.table, name)[self.row].item()
+	def set(self, value):
+		if self.table is None:
+			self.detached[name] = value
+		else:
+			getattr(self.table, name)[self.row] = value
+	return property(get, set)
+
+class Player(object):
+	"""A player in a solar system. Its simulation state lives in the
+	system's PlayerTable; the player object is a thin view onto its row
+	there, used by the networking code.
+
+	"""
+	x = player_field('x')
+	y = player_field('y')
+	direction = player_field('direction')
+	input = player_field('input') # bitmask of INPUTS
+	destroyed = player_field('destroyed')
+	respawning_in = player_field('respawning_in')
+	last_fired = player_field('last_fired')
+	interacting = player_field('interacting')
+	dirty = player_field('dirty')
 
-class Player:
 	def __init__(self, client, id, name, solar_system, position, size, projectiles):
 		self.client = client
 		self.id = id
 		self.name = name
 		self.solar_system = solar_system
-		self.x, self.y = position
 		self.width, self.height = size
-		self.rect = Rect(position, size)
 		self.projectiles = projectiles # projectile pool
-		self.direction = 0
-		self.input = [False for i in range(5)] # forward, left, right, fire, interact
-		self.last_fired = time.time()
-		self.destroyed = False
-		self.respawning_in = 0
-		self.interacting = False
-		self.interaction_point = None
-		self.dirty = True
+		self.table = None
+		self.row = None
+		x, y = position
+		self.detached = {'x': x, 'y': y, 'direction': 0.0, 'input': 0, 
+						 'destroyed': False, 'respawning_in': 0.0, 
+						 'last_fired': time.time(), 'interacting': False, 
+						 'dirty': True}
+		self.interaction_area = None
 
 	@classmethod
 	def from_offline(cls, offline_player, client, projectiles):
@@ -76,93 +152,309 @@ class Player:
 		self.connection.send(message_type, *data)
 
 	def set_input(self, key, state):
-		self.input[key] = True if state == 1 else False
+		if state == 1:
+			self.input |= 1 << key
+		else:
+			self.input &= ~(1 << key)
 
 	def destroy(self):
 		self.destroyed = True
 		self.respawning_in = 5
 
-	def respawn(self, x, y):
-		self.destroyed = False
-		print "respawn at: %i, %i" % (x, y) 
-		self.x = x
-		self.y = y
-
-	def collides_with(self, entity):
-		return self.rect.collides_with(entity.rect)
-
-	def move(self, distance):
-		self.x += math.sin(self.direction)*distance
-		self.y += math.cos(self.direction)*distance
-		self.rect.update_position(self.x, self.y)
 
-	def rotate(self, angle):
-		self.direction += angle
+class PlayerTable:
+	"""The players of a solar system, with their simulation state stored as
+	parallel NumPy arrays so that respawning, movement, rotation, firing and
+	bounding box updates each run as one vectorised pass. Row i belongs to
+	players[i]; removing a player moves the last row into its place.
 
-	def fire(self):
-		if time.time() - self.last_fired > PLAYER_FIRE_RATE:
-			self.last_fired = time.time()
-			print self.get_pos()
-			self.projectiles.append(Projectile(self.get_pos(), 
-									(PROJECTILE_SIZE, PROJECTILE_SIZE), 
-									self.direction, PROJECTILE_SPEED,
-									self, self.solar_system.projectile_id_counter))
-			self.solar_system.projectile_id_counter += 1
+	"""
+	STATE = (('x', numpy.float64), ('y', numpy.float64), ('direction', numpy.float64), 
+			 ('input', numpy.int64), ('destroyed', numpy.bool_), 
+			 ('respawning_in', numpy.float64), ('last_fired', numpy.float64), 
+			 ('interacting', numpy.bool_), ('dirty', numpy.bool_))
+	FIELDS = STATE + (('id', numpy.int64), ('left', numpy.float64), ('bottom', numpy.float64), 
+					  ('right', numpy.float64), ('top', numpy.float64))
 
-	def update(self, delta):
-		if self.destroyed:
-			# if the player has been destroyed, count down and then respawn
-			self.respawning_in -= delta
-			if self.respawning_in <= 0:
-				self.respawning_in = 0
-				size = self.solar_system.size
-				self.respawn(random.randint(0, size*2)-size, 
-							 random.randint(0, size*2)-size)
-		else:			
-			forward, left, right, fire, interact = self.input			
-			if interact and not self.interacting:
-				self.interacting = True
-				self.interaction_area = Rect((self.x - INTERACTION_AREA/2, self.y - INTERACTION_AREA/2), (INTERACTION_AREA, INTERACTION_AREA))
-			# if the player is still in play, act according to their inputs			
-			if forward:
-				self.move(PLAYER_SPEED*delta)
-				self.dirty = True
-			if left:
-				self.rotate(-PLAYER_TURN_SPEED*delta)				
-			elif right:
-				self.rotate(PLAYER_TURN_SPEED*delta)
-			if fire:
-				self.fire()
-
-
-class Projectile:
-	def __init__(self, position, size, direction, speed, player, projectile_id):
-		self.x, self.y = position
+	def __init__(self, size=(PLAYER_SIZE, PLAYER_SIZE), capacity=16):
 		self.width, self.height = size
-		self.rect = Rect(position, size)
-		self.direction = direction
-		self.speed = speed
-		self.player = player
-		self.id = projectile_id
-		self.alive_for = 0
-		self.destroyed = False
+		self.count = 0
+		self.capacity = capacity
+		self.players = []
+		for name, dtype in PlayerTable.FIELDS:
+			setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+		self.index = CellIndex(BROADPHASE_CELL_SIZE)
+
+	def __len__(self):
+		return self.count
+
+	def add(self, player):
+		"""Move a player's state into a new row and attach the player to it."""
+		_grow(self, PlayerTable.FIELDS, self.count+1)
+		row = self.count
+		for name, dtype in PlayerTable.STATE:
+			getattr(self, name)[row] = player.detached[name]
+		self.id[row] = player.id
+		self.count += 1
+		self.update_bounds(row, row+1)
+		self.players.append(player)
+		player.table, player.row, player.detached = self, row, None
+
+	def remove(self, player):
+		"""Detach a player, copying its state back onto the player object."""
+		row, last = player.row, self.count-1
+		player.detached = {name: getattr(self, name)[row].item() 
+						   for name, dtype in PlayerTable.STATE}
+		if row != last:
+			for name, dtype in PlayerTable.FIELDS:
+				array = getattr(self, name)
+				array[row] = array[last]
+			moved = self.players[last]
+			self.players[row] = moved
+			moved.row = row
+		self.players.pop()
+		self.count -= 1
+		player.table = player.row = None
+
+	def update_bounds(self, start, end):
+		self.left[start:end] = self.x[start:end]
+		self.right[start:end] = self.x[start:end] + self.width
+		self.bottom[start:end] = self.y[start:end]
+		self.top[start:end] = self.y[start:end] + self.height
+
+	def update(self, delta, solar_system, now):
+		n = self.count
+		if n == 0:
+			return
+		destroyed = self.destroyed[:n]
+		active = ~destroyed
+		# if a player has been destroyed, count down and then respawn
+		respawning_in = self.respawning_in[:n]
+		respawning_in[destroyed] -= delta
+		respawned = destroyed & (respawning_in <= 0)
+		if respawned.any():
+			count, size = numpy.count_nonzero(respawned), solar_system.size
+			respawning_in[respawned] = 0
+			self.x[:n][respawned] = numpy.random.randint(0, size*2+1, count) - size
+			self.y[:n][respawned] = numpy.random.randint(0, size*2+1, count) - size
+			destroyed[respawned] = False
+			self.dirty[:n][respawned] = True
+		# if a player is still in play, act according to their inputs
+		inputs = self.input[:n]
+		pressed = lambda key: active & ((inputs & (1 << key)) != 0)
+		interacting = self.interacting[:n]
+		for row in numpy.flatnonzero(pressed(INPUTS.INTERACT) & ~interacting):
+			interacting[row] = True
+			self.players[row].interaction_area = Rect(
+				(self.x[row] - INTERACTION_AREA/2, self.y[row] - INTERACTION_AREA/2), 
+				(INTERACTION_AREA, INTERACTION_AREA))
+		direction = self.direction[:n]
+		forward = pressed(INPUTS.FORWARD)
+		self.x[:n] += numpy.where(forward, numpy.sin(direction)*PLAYER_SPEED*delta, 0)
+		self.y[:n] += numpy.where(forward, numpy.cos(direction)*PLAYER_SPEED*delta, 0)
+		self.dirty[:n] |= forward
+		left = pressed(INPUTS.LEFT)
+		right = pressed(INPUTS.RIGHT) & ~left
+		direction += (right.astype(numpy.float64) - left)*PLAYER_TURN_SPEED*delta
+		self.update_bounds(0, n)
+		# fire
+		firing = numpy.flatnonzero(pressed(INPUTS.FIRE) 
+								   & (now - self.last_fired[:n] > PLAYER_FIRE_RATE))
+		if len(firing):
+			self.last_fired[firing] = now
+			first_id = solar_system.projectile_id_counter
+			solar_system.projectile_id_counter += len(firing)
+			solar_system.projectiles.add_many(numpy.arange(first_id, first_id+len(firing)), 
+											  self.x[firing], self.y[firing], 
+											  self.direction[firing], PROJECTILE_SPEED, 
+											  self.id[firing])
+
+	def build_index(self):
+		n = self.count
+		self.index.build(self.left[:n], self.bottom[:n])
+
+	def query_index(self, left, bottom, right, top):
+		"""Return the rows of players in play whose bounds overlap the given
+		bounds, using the index from the last build_index call.
 
-	def move(self, distance):
-		self.x += math.sin(self.direction)*distance
-		self.y += math.cos(self.direction)*distance
+		"""
+		# a player overlaps if its corner is within the bounds grown by its size
+		rows = self.index.query(left - self.width, bottom - self.height, right, top)
+		hit = (~self.destroyed[rows] & (self.right[rows] >= left) & (self.left[rows] <= right) 
+			   & (self.top[rows] >= bottom) & (self.bottom[rows] <= top))
+		return rows[hit]
+
+
+class CellIndex:
+	"""Broadphase over points stored in NumPy arrays. build sorts the points
+	by grid cell, and query finds the points in the cells a box overlaps
+	with a binary search per cell.
+
+	"""
+	def __init__(self, cell_size):
+		self.cell_size = float(cell_size)
+		self.order = numpy.zeros(0, dtype=numpy.int64)
+		self.sorted_keys = numpy.zeros(0, dtype=numpy.int64)
+
+	@staticmethod
+	def cell_keys(cell_x, cell_y):
+		return (cell_x + (1 << 20)) * (1 << 21) + (cell_y + (1 << 20))
+
+	def build(self, x, y):
+		keys = self.cell_keys(numpy.floor(x/self.cell_size).astype(numpy.int64),
+							  numpy.floor(y/self.cell_size).astype(numpy.int64))
+		self.order = numpy.argsort(keys, kind='mergesort')
+		self.sorted_keys = keys[self.order]
+
+	def query(self, left, bottom, right, top):
+		"""Return the indices, in order, of the points in every cell the given
+		bounds overlap. Callers test the candidates against the bounds.
+
+		"""
+		candidates = []
+		for cell_x in xrange(int(math.floor(left/self.cell_size)), 
+							 int(math.floor(right/self.cell_size))+1):
+			for cell_y in xrange(int(math.floor(bottom/self.cell_size)), 
+								 int(math.floor(top/self.cell_size))+1):
+				key = self.cell_keys(cell_x, cell_y)
+				start = numpy.searchsorted(self.sorted_keys, key, 'left')
+				end = numpy.searchsorted(self.sorted_keys, key, 'right')
+				if end > start:
+					candidates.append(self.order[start:end])
+		if not candidates:
+			return numpy.zeros(0, dtype=numpy.int64)
+		return numpy.sort(numpy.concatenate(candidates))
+
+
+def _grow(store, fields, needed):
+	"""Double the capacity of a structure-of-arrays store until it can hold
+	needed entries, copying over the count entries in use.
+
+	"""
+	if needed <= store.capacity:
+		return
+	while store.capacity < needed:
+		store.capacity *= 2
+	for name, dtype in fields:
+		array = numpy.zeros(store.capacity, dtype=dtype)
+		array[:store.count] = getattr(store, name)[:store.count]
+		setattr(store, name, array)
+
+def round_half_away(values):
+	"""Round an array the way round() does, with halves away from zero
+	rather than to even like numpy.rint.
+
+	"""
+	magnitude = numpy.abs(values)
+	rounded = numpy.floor(magnitude)
+	rounded += magnitude - rounded >= 0.5
+	return numpy.copysign(rounded, values)
+
+def quantize_arrays(quantizer, x, y, direction):
+	"""Quantize arrays of positions and directions for a frame, encoding each
+	value exactly as quantizer.position and quantizer.angle would.
+
+	"""
+	limit = quantizer.position_limit
+	return (numpy.clip(round_half_away(x/quantizer.position_scale), -limit, limit).astype(numpy.int64), 
+			numpy.clip(round_half_away(y/quantizer.position_scale), -limit, limit).astype(numpy.int64), 
+			round_half_away(direction/quantizer.angle_scale).astype(numpy.int64) % quantizer.angle_steps)
+
+
+class ProjectileStore:
+	"""A solar system's projectiles, stored as parallel NumPy arrays so that
+	movement, expiry, collision tests and compaction each run as a single
+	vectorised step. Only the first count entries are in use, and
+	projectiles are killed by clearing their alive flag and removed by
+	compact().
+
+	"""
+	FIELDS = (('id', numpy.int64), ('x', numpy.float64), ('y', numpy.float64), 
+			  ('direction', numpy.float64), ('speed', numpy.float64), 
+			  ('owner', numpy.int64), ('age', numpy.float64), ('alive', numpy.bool_))
+
+	def __init__(self, capacity=64):
+		self.count = 0
+		self.capacity = capacity
+		for name, dtype in ProjectileStore.FIELDS:
+			setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+		self.index = CellIndex(BROADPHASE_CELL_SIZE)
+
+	def __len__(self):
+		return self.count
+
+	def add_many(self, ids, x, y, direction, speed, owner):
+		"""Add a projectile for each element of the given arrays."""
+		count = len(ids)
+		_grow(self, ProjectileStore.FIELDS, self.count+count)
+		new = slice(self.count, self.count+count)
+		self.id[new], self.x[new], self.y[new] = ids, x, y
+		self.direction[new], self.speed[new], self.owner[new] = direction, speed, owner
+		self.age[new], self.alive[new] = 0, True
+		self.count += count
 
 	def update(self, delta):
-		self.move(self.speed*delta)
-		self.alive_for += delta
-		if self.alive_for >= config.PROJECTILE_LIFE:
-			self.destroy()
+		"""Move every projectile and kill the ones that have expired."""
+		n = self.count
+		distance = self.speed[:n]*delta
+		self.x[:n] += numpy.sin(self.direction[:n])*distance
+		self.y[:n] += numpy.cos(self.direction[:n])*distance
+		self.age[:n] += delta
+		self.alive[:n] &= self.age[:n] < config.PROJECTILE_LIFE
+
+	def compact(self):
+		"""Remove dead projectiles, keeping the survivors in order."""
+		n = self.count
+		keep = numpy.flatnonzero(self.alive[:n])
+		if len(keep) == n:
+			return
+		for name, dtype in ProjectileStore.FIELDS:
+			array = getattr(self, name)
+			array[:len(keep)] = array[keep]
+		self.count = len(keep)
 
-	def destroy(self):
-		self.destroyed = True
+	def build_index(self):
+		n = self.count
+		self.index.build(self.x[:n], self.y[:n])
 
-	def collides_with(self, entity):
-		return self.rect.collides_with(entity.rect)
+	def query_index(self, left, bottom, right, top):
+		"""Return the indices of live projectiles colliding with the given
+		bounds, using the index from the last build_index call.
 
+		"""
+		# a projectile collides if its corner is within the bounds grown by its size
+		left, bottom = left - PROJECTILE_SIZE, bottom - PROJECTILE_SIZE
+		candidates = self.index.query(left, bottom, right, top)
+		x, y = self.x[candidates], self.y[candidates]
+		hit = (self.alive[candidates] & (x >= left) & (x <= right) 
+			   & (y >= bottom) & (y <= top))
+		return candidates[hit]
+
+
+def run_worker(channel):
+	"""Entry point of a gameserver worker process, see Manager.start_workers."""
+	Manager().run_worker(channel)
+
+def interest_rows(rows, last_rows, far_due, centre, ids, x, y):
+	"""Pick the rows in a player's area of interest around centre. Distant
+	rows are only brought up to date when far_due, otherwise the client is
+	sent the same value as last time.
+
+	"""
+	centre_x, centre_y = centre
+	distance = (x - centre_x)**2 + (y - centre_y)**2
+	near = distance <= INTEREST_RADIUS**2
+	far = ~near & (distance <= INTEREST_FAR_RADIUS**2)
+	visible = {row_id: rows[row_id] for row_id in ids[near].tolist()}
+	for row_id in ids[far].tolist():
+		visible[row_id] = rows[row_id] if far_due or row_id not in last_rows else last_rows[row_id]
+	return visible
+
+def rows_by_id(ids, *columns):
+	"""Zip columns (arrays or lists) into frame rows keyed by id."""
+	columns = [column.tolist() if isinstance(column, numpy.ndarray) else column 
+			   for column in columns]
+	return dict(zip(ids.tolist(), [list(row) for row in zip(*columns)]))
 
 class SolarSystemEntity:
 	def __init__(self, id, orbiting=None, distance=None, speed=None, degree=0, position=None):
@@ -171,6 +463,7 @@ class SolarSystemEntity:
 		self.distance = distance
 		self.speed = speed
 		self.degree = degree
+		self.degree0 = degree # degree at sim time 0
 		if self.orbiting is None and position is not None:
 			self.x, self.y = position
 		elif self.orbiting is None:
@@ -178,17 +471,18 @@ class SolarSystemEntity:
 		else:
 			self.set_position()
 
-	def update(self, delta):
-		if self.orbiting is not None:
-			self.degree += self.speed*delta
-			if self.speed > 0 and self.degree >= config.MAX_RAD: self.degree -= config.MAX_RAD
-			elif self.speed < 0 and self.degree < 0: self.degree = config.MAX_RAD + self.degree
-			self.set_position()
-
 	def set_position(self):
 		if self.orbiting is not None:
-			self.x = self.orbiting.x + math.sin(self.degree)*self.distance
-			self.y = self.orbiting.y + math.cos(self.degree)*self.distance
+			self.place(self.degree, 
+					   self.orbiting.x + math.sin(self.degree)*self.distance, 
+					   self.orbiting.y + math.cos(self.degree)*self.distance)
+
+	def place(self, degree, x, y):
+		self.degree, self.x, self.y = degree, x, y
+		self.moved()
+
+	def moved(self):
+		pass
 
 	def __eq__(self, other):
 		if not isinstance(other, SolarSystemEntity):
@@ -203,8 +497,7 @@ class Planet(SolarSystemEntity):
 		self.rect = Rect((0, 0), (self.size*2, self.size*2))
 		SolarSystemEntity.__init__(self, id, orbiting, distance, speed, degree, position)		
 
-	def set_position(self):
-		SolarSystemEntity.set_position(self)
+	def moved(self):
 		self.rect.update_position(self.x-self.size, self.y-self.size)
 
 class WormholeMouth(SolarSystemEntity):
@@ -214,10 +507,52 @@ class WormholeMouth(SolarSystemEntity):
 		self.rect = Rect((0, 0), (WORMHOLE_SIZE*2, WORMHOLE_SIZE*2))
 		SolarSystemEntity.__init__(self, id, orbiting, distance, speed, degree, position)		
 
-	def set_position(self):
-		SolarSystemEntity.set_position(self)
+	def moved(self):
 		self.rect.update_position(self.x-WORMHOLE_SIZE, self.y-WORMHOLE_SIZE)
 
+class OrbitTable:
+	"""The orbits of a solar system's entities. Orbits are deterministic, so
+	rather than stepping every entity each tick, positions are computed
+	from (degree0, speed, sim time) for all entities at once, and only when
+	something needs them. Entities are assumed to orbit fixed points.
+
+	"""
+	def __init__(self):
+		self.entities = []
+		self.degree0 = numpy.zeros(0)
+		self.speed = numpy.zeros(0)
+		self.distance = numpy.zeros(0)
+		self.centre_x = numpy.zeros(0)
+		self.centre_y = numpy.zeros(0)
+		self.time = None # sim time the entities were last placed at
+
+	def add(self, entity):
+		if entity.orbiting is None:
+			return
+		self.entities.append(entity)
+		self.degree0 = numpy.append(self.degree0, entity.degree0)
+		self.speed = numpy.append(self.speed, entity.speed)
+		self.distance = numpy.append(self.distance, entity.distance)
+		self.centre_x = numpy.append(self.centre_x, entity.orbiting.x)
+		self.centre_y = numpy.append(self.centre_y, entity.orbiting.y)
+		self.time = None
+
+	def positions(self, sim_time):
+		"""Return arrays of (degree, x, y) for every orbit at sim_time."""
+		degree = (self.degree0 + self.speed*sim_time) % config.MAX_RAD
+		return (degree, self.centre_x + numpy.sin(degree)*self.distance, 
+				self.centre_y + numpy.cos(degree)*self.distance)
+
+	def evaluate(self, sim_time):
+		"""Place every entity where its orbit puts it at sim_time."""
+		if sim_time == self.time:
+			return
+		self.time = sim_time
+		degree, x, y = self.positions(sim_time)
+		for entity, entity_degree, entity_x, entity_y in zip(self.entities, degree.tolist(), 
+															 x.tolist(), y.tolist()):
+			entity.place(entity_degree, entity_x, entity_y)
+
 class SolarSystem:
 	def __init__(self, id, name):
 		self.id = id
@@ -238,7 +573,7 @@ class RemoteSolarSystem(SolarSystem):
 
 	def receive_player(self, player, origin_system):
 		self.server.send_player(player.id, player.name, self.id, origin_system.id)
-		manager.move_player(player, self.server, self)
+		self.manager.move_player(player, self.server, self)
 
 class LocalSolarSystem(SolarSystem):
 	"""Represents a solar system hosted on this server."""
@@ -246,16 +581,26 @@ class LocalSolarSystem(SolarSystem):
 		SolarSystem.__init__(self, id, name)
 		self.size = size
 		self.manager = manager
-		self.players = []
+		self.player_table = PlayerTable()
+		self.players = self.player_table.players
 		self.entities = []
 		self.wormhole_mouths = []
+		self.arrival_mouths = {} # origin system id: mouth players from there arrive at
 		self.planets = []
-		self.projectiles = []
-		self.destroyed = []
+		self.orbits = OrbitTable()
+		self.projectiles = ProjectileStore()
+		self.destroyed = [] # players and projectile ids destroyed this frame
+		self.entity_hash = SpatialHash(BROADPHASE_CELL_SIZE) # planets and wormhole mouths
 		self.pivot = SolarSystemEntity(-1, position=(0, 0))
-		self.new_players = []
 		self.projectile_id_counter = 0
-		self.dirty_players = []
+		self.update_stat = 'system.%i.update' % id
+		self.players_stat = 'system.%i.players' % id
+		self.dormant = True # not updated while there are no players or projectiles
+		self.quantizer = None
+		if QUANTIZE_FRAMES:
+			position_limit = (1 << (QUANTIZE_POSITION_BITS-1)) - 1
+			self.quantizer = network.Quantizer(size*QUANTIZE_POSITION_RANGE/position_limit, 
+											   QUANTIZE_ANGLE_STEPS, QUANTIZE_POSITION_BITS)
 
 	def get_updates_for_db(self):
 		return None
@@ -263,100 +608,209 @@ class LocalSolarSystem(SolarSystem):
 	def add_planet(self, planet):
 		self.entities.append(planet)
 		self.planets.append(planet)
+		self.orbits.add(planet)
 
 	def add_wormhole(self, wormhole):
 		self.entities.append(wormhole)
 		self.wormhole_mouths.append(wormhole)
+		self.orbits.add(wormhole)
 
 	def receive_player(self, player, origin_system):
-		wormhole = None
-		for w in self.wormhole_mouths:
-			if w.destination.id == origin_system.id:
-				wormhole = w		
+		self.evaluate_orbits()
+		wormhole = self.arrival_mouths[origin_system.id]
 		self.add_player(player, (wormhole.x, wormhole.y))
 
 	def remove_player(self, player):
 		print "Player removed from solar system %i" % self.id
-		self.players.remove(player)
+		self.player_table.remove(player)
 
 	def add_player(self, player, position): # TODO: do this better
 		print "Player added to solar system %i" % self.id
+		self.wake()
 		self.manager.send_map_info(self, player)
 		new_player = Player(player.client, player.id, player.name, 
 							self, position, (player.width, player.height), 
 							self.projectiles)
 		player.client.player = new_player
-		self.players.append(new_player)
-		self.new_players.append(new_player)
+		player.client.reset_snapshots() # the first frame is sent in full
+		self.player_table.add(new_player)
 		return True
 
+	def wake(self):
+		"""Start updating the system again. Orbits are evaluated from sim time,
+		so there is nothing to catch up on other than placing the entities.
+
+		"""
+		if self.dormant:
+			self.dormant = False
+			self.evaluate_orbits()
+			self.manager.active_systems[self.id] = self
+
+	def is_empty(self):
+		return not self.players and not len(self.projectiles)
+
 	def update(self, delta):
-		# update entities, players and projectiles
-		for entity in self.entities:
-			entity.update(delta)
-		for player in self.players:
-			player.update(delta)
-			if player.dirty and player not in self.dirty_players:
-				self.dirty_players.append(player)
-			player.dirty = False
-		for projectile in self.projectiles:
-			projectile.update(delta)
+		# update players and projectiles, entities are only placed when needed
+		self.player_table.update(delta, self, time.time())
+		self.projectiles.update(delta)
+		if self.is_empty():
+			self.destroyed = []
+			return
+		self.build_broadphase()
+		self.collisions()
 		# send the player through a wormhole if they interact with it
-		for player in (player for player in self.players if not player.destroyed):
-			if player.interacting: 
-				for wormhole in self.wormhole_mouths:
-					if player.interaction_area.collides_with(wormhole.rect):
-						self.send_player_to_system(player, wormhole.destination)
-						break
-				player.interacting = False
-				player.interaction_area = None
+		leaving = []
+		table = self.player_table
+		n = len(table)
+		for row in numpy.flatnonzero(table.interacting[:n] & ~table.destroyed[:n]):
+			player = self.players[row]
+			for entity in self.entity_hash.query_colliding(player.interaction_area):
+				if isinstance(entity, WormholeMouth):
+					leaving.append((player, entity.destination))
+					break
+			table.interacting[row] = False
+			player.interaction_area = None
+		for player, destination in leaving:
+			self.send_player_to_system(player, destination)
 		# clean up destroyed projectiles
-		for projectile in self.projectiles:
-			if projectile.destroyed:
-				self.projectiles.remove(projectile)
-		self.send_frame()
+		self.projectiles.compact()
+
+	def evaluate_orbits(self):
+		self.orbits.evaluate(self.manager.sim_time)
+
+	def build_broadphase(self):
+		self.evaluate_orbits()
+		self.entity_hash.clear()
+		for entity in self.planets:
+			self.entity_hash.insert(entity, entity.rect)
+		for entity in self.wormhole_mouths:
+			self.entity_hash.insert(entity, entity.rect)
+		self.player_table.build_index()
+		self.projectiles.build_index()
 
 	def collisions(self):
-		# destroy any players or projectiles colliding with planets
-		for planet in self.planets:			
-			for player in (player for player in self.players if not player.destroyed):
-				if player.collides_with(planet):
-					player.destroy()
-					print "player destroyed"
-					print player.get_pos(), (planet.x, planet.y)
-					self.destroyed.append(player)
-			for projectile in self.projectiles:
-				if projectile.collides_with(planet):
-					self.projectiles.remove(projectile)
-					self.destroyed.append(projectile)
-		# destroy any players and projectiles colliding with each other
-		for projectile in self.projectiles:
-			for player in (player for player in self.players if not player.destroyed 
-						   and not player == projectile.player):
-				if projectile.collides_with(player):
-					self.projectiles.remove(projectile)
-					player.destroy()
-					self.destroyed.extend([player, projectile])
-
-	def send_frame(self):		
-		player_data = [[pl.id, pl.x, pl.y, pl.direction, pl.input, pl.destroyed, pl.respawning_in] 
-					   for pl in self.players]		
-		projectile_data = [[pr.id, pr.x, pr.y, pr.direction, pr.player.id]
-						   for pr in self.projectiles]
-		new_players = [[pl.id, pl.name] for pl in self.new_players]
-		self.new_players = []
-		frame_data = [player_data, projectile_data, new_players]
-		for player in self.players:
-			player.client.socket.send_message(MSG.GW_CL_FRAME, frame_data)
+		"""Destroy players and projectiles that hit planets, and players hit by
+		other players' projectiles. Destroyed projectiles are only marked dead
+		here and removed at the end of the frame.
+
+		"""
+		self.destroyed = []
+		table = self.player_table
+		projectiles = self.projectiles
+		# destroy any players and projectiles colliding with planets
+		for planet in self.planets:
+			planet_bounds = planet.rect.left, planet.rect.bottom, planet.rect.right, planet.rect.top
+			for row in table.query_index(*planet_bounds).tolist():
+				player = self.players[row]
+				player.destroy()
+				print "player destroyed"
+				print player.get_pos(), (planet.x, planet.y)
+				self.destroyed.append(player)
+			hits = projectiles.query_index(*planet_bounds)
+			if len(hits):
+				projectiles.alive[hits] = False
+				self.destroyed.extend(projectiles.id[hits].tolist())
+		# destroy any players and projectiles colliding with each other, the
+		# oldest projectile hitting a player being the one used up
+		n = len(table)
+		live = numpy.flatnonzero(~table.destroyed[:n])
+		bounds = zip(table.left[live].tolist(), table.bottom[live].tolist(), 
+					 table.right[live].tolist(), table.top[live].tolist())
+		for row, player_bounds in zip(live.tolist(), bounds):
+			player = self.players[row]
+			hits = projectiles.query_index(*player_bounds)
+			if len(hits):
+				hits = hits[projectiles.owner[hits] != player.id]
+			if len(hits):
+				projectiles.alive[hits[0]] = False
+				player.destroy()
+				self.destroyed.extend([player, projectiles.id[hits[0]]])
+
+	def send_frame(self, now):
+		"""Send each player the changes to their area of interest since the
+		last snapshot their client acknowledged. Entities leaving the area
+		are sent as removed rows and ones entering it in full. Players whose
+		next frame isn't due yet are skipped; their next frame covers the
+		gap. Frame deadlines advance by each client's snapshot_interval
+		rather than being reset to now, so passes that run a little early or
+		late don't drop frames. Distant entities are refreshed on their own
+		FAR_SNAPSHOT_RATE deadline in the same way.
+
+		"""
+		slack = self.manager.snapshot_rate / 2 # passes this close to a deadline are on time
+		due = [player for player in self.players 
+			   if now >= player.client.next_snapshot - slack]
+		if not due:
+			return
+		stats = self.manager.stats
+		player_rows, projectile_rows = self.frame_rows()
+		table, projectiles = self.player_table, self.projectiles
+		n, m = len(table), len(projectiles)
+		snapshot_id = self.manager.next_snapshot_id()
+		# entries shared between players are only worked out and encoded once
+		deltas = network.DeltaEncoder()
+		for player in due:
+			client = player.client
+			client.next_snapshot = max(client.next_snapshot, now) + client.snapshot_interval
+			far_due = now >= client.next_far_snapshot - slack
+			if far_due:
+				client.next_far_snapshot = max(client.next_far_snapshot, now) + FAR_SNAPSHOT_RATE
+			last_players, last_projectiles = client.view
+			centre = (player.x, player.y)
+			visible_players = interest_rows(player_rows, last_players, far_due, centre, 
+											table.id[:n], table.x[:n], table.y[:n])
+			visible_projectiles = interest_rows(projectile_rows, last_projectiles, far_due, centre, 
+												projectiles.id[:m], projectiles.x[:m], 
+												projectiles.y[:m])
+			baseline_id = client.acked_snapshot if client.acked_snapshot in client.snapshots else -1
+			baseline_players, baseline_projectiles = client.snapshots.get(baseline_id, (None, None))
+			changed_players, removed_players = deltas.delta_rows(visible_players, baseline_players)
+			changed_projectiles, removed_projectiles = deltas.delta_rows(visible_projectiles, 
+																		 baseline_projectiles)
+			with stats.timer('frame.encode'):
+				body = network.package_body([snapshot_id, baseline_id, 
+											 changed_players, removed_players, 
+											 changed_projectiles, removed_projectiles], 
+											client.socket.codec)
+			with stats.timer('frame.send'):
+				client.socket.send_body(MSG.GW_CL_FRAME, body)
+			# keep what was sent as a baseline for future deltas
+			client.store_snapshot(snapshot_id, visible_players, visible_projectiles)
+
+	def frame_rows(self):
+		"""Build the player and projectile rows for a frame, quantizing
+		positions and directions if enabled.
+
+		"""
+		table, projectiles = self.player_table, self.projectiles
+		n, m = len(table), len(projectiles)
+		player_x, player_y, player_direction = table.x[:n], table.y[:n], table.direction[:n]
+		projectile_x, projectile_y = projectiles.x[:m], projectiles.y[:m]
+		projectile_direction = projectiles.direction[:m]
+		if self.quantizer is not None:
+			player_x, player_y, player_direction = quantize_arrays(
+				self.quantizer, player_x, player_y, player_direction)
+			projectile_x, projectile_y, projectile_direction = quantize_arrays(
+				self.quantizer, projectile_x, projectile_y, projectile_direction)
+		player_rows = rows_by_id(table.id[:n], player_x, player_y, player_direction, 
+								 table.input[:n], table.destroyed[:n], 
+								 table.respawning_in[:n], [player.name for player in self.players])
+		projectile_rows = rows_by_id(projectiles.id[:m], projectile_x, projectile_y, 
+									 projectile_direction, projectiles.owner[:m])
+		return player_rows, projectile_rows
 
 	def send_player_to_system(self, player, system):
-		self.players.remove(player)
+		self.player_table.remove(player)
 		player.client.socket.send_message(MSG.GW_CL_MOVING_SYSTEMS, system.name)
 		system.receive_player(player, self)
 
 	def get_updates_for_db(self):		
-		dirty = [[player.id, player.x, player.y, self.id] for player in self.dirty_players if player in self.players]
-		self.dirty_players = []
+		table = self.player_table
+		n = len(table)
+		rows = numpy.flatnonzero(table.dirty[:n])
+		dirty = [[player_id, x, y, self.id] for player_id, x, y 
+				 in zip(table.id[rows].tolist(), table.x[rows].tolist(), table.y[rows].tolist())]
+		table.dirty[:n] = False
 		return dirty
 
 class Server:
@@ -373,20 +827,36 @@ class Server:
 														origin_system_id])
 
 class Manager:
-	def __init__(self):
+	def __init__(self, worker_count=0, stats_file=None, stats_port=None):
 		self.servers = []
 		self.servers_by_system = {}
 		self.solar_systems = []
 		self.solar_systems_by_id = {} # including edge systems
-		self.players = []
-		self.players_by_id = {}
-		self.last_frame = -1
-		self.last_db_frame = -1
+		self.players = collections.OrderedDict() # player id: OfflinePlayer
+		self.snapshot_id_counter = 0
+		self.snapshot_id_step = 1
+		self.stats = stats.Stats(STATS_ENABLED)
+		self.stats_file = stats_file # where to dump stats every STATS_DUMP_RATE seconds
+		self.stats_port = stats_port # local port to serve stats on
+		self.snapshot_rate = SNAPSHOT_RATE
+		self.sim_time = 0.0 # seconds simulated so far, orbits are evaluated against this
+		self.active_systems = collections.OrderedDict() # system id: local system that isn't dormant
+		self.reported_systems = None
+		self.clients_by_id = {}
+		# worker processes, see start_workers
+		self.worker_count = worker_count
+		self.workers = []
+		self.workers_by_system = {} # local system id: Channel to the worker running it
+		self.channel = None # in a worker, the Channel to the main process
+		self.scheduler = None
+		self.reported_ticks = {}
 		# sockets
 		self.gateway_sock = None
 		self.database_sock = None
 
 	def begin(self, client_port, server_port):
+		if self.worker_count:
+			self.start_workers()
 		# start listening for peer connections
 		self.alpha_servers = []
 		server_greenlet = gevent.spawn(self.wait_for_other_servers, server_port)
@@ -450,9 +920,10 @@ class Manager:
 		client_greenlet = gevent.spawn(self.accept_client_connections, client_port)
 		# begin processing
 		print "Running game server"
-		self.last_frame = time.time()
-		self.last_db_frame = time.time()
-		run_greenlet = gevent.spawn(self.run)
+		if self.workers:
+			run_greenlet = gevent.spawn(self.build_workers, solar_data)
+		else:
+			run_greenlet = gevent.spawn(self.run)
 		# send ready signal
 		print "Notifying gateway of readiness"
 		gateway_greenlet = gevent.spawn(self.receive_gateway_input)
@@ -502,8 +973,7 @@ class Manager:
 				offline_player = OfflinePlayer(player_id, username, 
 											   x, y, 
 											   self.systems_by_id[system_id])
-				self.players.append(offline_player)
-				self.players_by_id[player_id] = offline_player
+				self.players[player_id] = offline_player
 
 	def receive_server_input(self, server):
 		while True:
@@ -511,22 +981,17 @@ class Manager:
 			if msg.type == MSG.GS_GS_SENDPLAYER:
 				player_id, player_name, destination_system_id, origin_system_id = msg.data
 				system = self.systems_by_id[destination_system_id]
-				wormhole = None
-				for w in system.wormhole_mouths:
-					if w.destination.id == origin_system_id:
-						wormhole = w
-						break
+				system.evaluate_orbits()
+				wormhole = system.arrival_mouths[origin_system_id]
 				offline_player = OfflinePlayer(player_id, player_name, 
-											   wormhole.x, wormhole.y, system)
-				self.players.append(offline_player)
-				self.players_by_id[player_id] = offline_player
+											   wormhole.x, wormhole.y, system, origin_system_id)
+				self.players[player_id] = offline_player
 
 	def move_player(self, player, server, system):
 		self.gateway_sock.send_message(MSG.GS_GW_MOVEPLAYER, [player.id, server.id, system.id])
-		offline_player = self.players_by_id[player.id]
 		player.client.socket.close()
-		self.players.remove(offline_player)
-		del self.players_by_id[player.id]
+		self.clients_by_id.pop(player.client.id, None)
+		del self.players[player.id]
 
 	def accept_client_connections(self, port):
 		client_id_counter = 0
@@ -539,6 +1004,7 @@ class Manager:
 			print "Client " + str(client_id_counter) + " connected"
 			client = Client(c_sock, address)
 			client.id = client_id_counter
+			self.clients_by_id[client.id] = client
 			gevent.spawn(self.receive_client_input, client)
 			client_id_counter += 1
 
@@ -549,11 +1015,14 @@ class Manager:
 				if msg is None:
 					break
 				player_id = msg.data
-				offline_player = self.players_by_id[player_id]
+				offline_player = self.players[player_id]
 				system = offline_player.solar_system
 				player = Player.from_offline(offline_player, client, system.projectiles)
 				client.player = player				
-				system.add_player(player, player.get_pos())
+				if self.workers:
+					self.send_to_worker(client, system, offline_player.arrived_from)
+				else:
+					system.add_player(player, player.get_pos())
 			else:
 				msg = client.socket.wait_for_message()
 				if msg is None:
@@ -561,10 +1030,22 @@ class Manager:
 					break
 				if msg.type == MSG.CL_GW_INPUT:
 					key, state = msg.data
-					client.player.set_input(key, state)
+					if self.workers:
+						client.worker.send(workers.WORKER_MSG.INPUT, client.id, key, state)
+					else:
+						client.player.set_input(key, state)
+				elif msg.type == MSG.CL_GW_FRAME_ACK:
+					if self.workers:
+						client.worker.send(workers.WORKER_MSG.ACK, client.id, msg.data)
+					else:
+						client.acked_snapshot = max(client.acked_snapshot, msg.data)
 				elif msg.type == MSG.CL_GW_LOGOUT:
-					client.player.solar_system.remove_player(client.player)
+					if self.workers:
+						client.worker.send(workers.WORKER_MSG.LOGOUT, client.id)
+					else:
+						client.player.solar_system.remove_player(client.player)
 					client.socket.close()
+					del self.clients_by_id[client.id]
 					print "Client %i logged out" % client.id
 					break
 
@@ -574,31 +1055,203 @@ class Manager:
 			client.connected = False
 			# remove the player from the game world
 			if client.player is not None: # TODO: this isn't going to work
-				self.players.remove(client.player)
+				del self.players[client.player.id]
 			# close the socket
 			client.sock.shutdown()
 			client.sock.close()
 		elif msg.type == network.MSG.CL_GW_INPUT:
 			pass # handle input
 
-	def run(self):		
-		while True:
-			delta = time.time() - self.last_frame
-			if delta >= FRAME_RATE:
-				self.last_frame += delta
-				for solar_system in self.solar_systems:
-					solar_system.update(delta)
-			db_delta = time.time() - self.last_db_frame
-			if db_delta >= DATABASE_FRAME_RATE:
-				# update database every DB frame
-				self.last_db_frame += db_delta
-				dirty_players = []
-				for solar_system in self.solar_systems:
-					dirty_players.extend(solar_system.get_updates_for_db())
-				if dirty_players:
-					self.database_sock.send_message(MSG.DB_QUERY, 
-													[DBQUERY.GS_UPDATE, dirty_players])
-			gevent.sleep()
+	def start_workers(self):
+		"""Fork the worker processes. This happens before anything else, so
+		they don't inherit any sockets or greenlets; they're given their
+		systems by build_workers once the solar system data has arrived.
+
+		"""
+		for i in xrange(self.worker_count):
+			self.workers.append(workers.start_worker(run_worker))
+
+	def build_workers(self, solar_data):
+		"""Share the local systems out between the workers, then route their
+		output until they exit.
+
+		"""
+		for i, worker in enumerate(self.workers):
+			system_ids = [system.id for system in self.solar_systems[i::len(self.workers)]]
+			for system_id in system_ids:
+				self.workers_by_system[system_id] = worker
+			worker.send(workers.WORKER_MSG.BUILD, solar_data, system_ids, i, len(self.workers), 
+						self.stats_file, self.stats_port)
+		gevent.joinall([gevent.spawn(self.receive_worker_input, worker) 
+						for worker in self.workers])
+
+	def send_to_worker(self, client, system, arrived_from=None):
+		"""Hand a player over to the worker running their system."""
+		client.worker = self.workers_by_system[system.id]
+		player = client.player
+		client.worker.send(workers.WORKER_MSG.JOIN, client.id, client.socket.codec, player.id, 
+						   player.name, player.x, player.y, system.id, arrived_from)
+
+	def receive_worker_input(self, worker):
+		for kind, args in worker.messages():
+			if kind == workers.WORKER_MSG.SEND:
+				socket_id, msg_type, body = args
+				if socket_id == workers.DATABASE:
+					sock = self.database_sock
+				elif socket_id in self.clients_by_id:
+					sock = self.clients_by_id[socket_id].socket
+				else:
+					continue # the client has gone
+				sock.send_body(msg_type, body)
+			elif kind == workers.WORKER_MSG.CLOSE:
+				if args[0] in self.clients_by_id:
+					self.clients_by_id[args[0]].socket.close()
+			elif kind == workers.WORKER_MSG.TRANSFER:
+				client_id, player_id, player_name, destination_id, origin_id = args
+				client = self.clients_by_id.get(client_id)
+				if client is None:
+					continue
+				system = self.systems_by_id[destination_id]
+				if isinstance(system, RemoteSolarSystem):
+					system.receive_player(client.player, self.systems_by_id[origin_id])
+				else:
+					self.send_to_worker(client, system, origin_id)
+		print "A worker has exited"
+
+	def run_worker(self, channel):
+		"""Run as a worker process: wait for our systems, then simulate them
+		while taking players and their input from the main process.
+
+		"""
+		self.channel = channel
+		self.database_sock = workers.ProxySocket(channel, workers.DATABASE, config.MSG_CODEC)
+		self.receive_main_input()
+
+	def keep_systems(self, system_ids):
+		"""Drop the local systems this worker doesn't run. Players headed for
+		them, or for other servers' systems, are handed to the main process.
+
+		"""
+		proxies = {system_id: workers.ProxySolarSystem(self, system_id, system.name)
+				   for system_id, system in self.systems_by_id.iteritems() 
+				   if system_id not in system_ids}
+		self.solar_systems = [system for system in self.solar_systems if system.id in system_ids]
+		for system in self.solar_systems:
+			for mouth in system.wormhole_mouths:
+				if mouth.destination is not None and mouth.destination.id in proxies:
+					mouth.destination = proxies[mouth.destination.id]
+		self.systems_by_id.update(proxies)
+
+	def receive_main_input(self):
+		for kind, args in self.channel.messages():
+			if kind == workers.WORKER_MSG.BUILD:
+				solar_data, system_ids, index, count, stats_file, stats_port = args
+				# keep snapshot ids unique across the workers
+				self.snapshot_id_counter, self.snapshot_id_step = index, count
+				# each worker keeps its own stats
+				if stats_file is not None:
+					self.stats_file = '%s.%i' % (stats_file, index)
+				if stats_port is not None:
+					self.stats_port = stats_port + index + 1
+				self.build_systems(solar_data)
+				self.keep_systems(set(system_ids))
+				print "Worker %i running systems %s" % (index, system_ids)
+				gevent.spawn(self.run)
+			elif kind == workers.WORKER_MSG.JOIN:
+				client_id, codec, player_id, name, x, y, system_id, arrived_from = args
+				client = Client(workers.ProxySocket(self.channel, client_id, codec))
+				client.id = client_id
+				self.clients_by_id[client_id] = client
+				system = self.systems_by_id[system_id]
+				player = Player.from_offline(OfflinePlayer(player_id, name, x, y, system), 
+											 client, system.projectiles)
+				if arrived_from is None:
+					system.add_player(player, player.get_pos())
+				else:
+					system.receive_player(player, self.systems_by_id[arrived_from])
+			elif args[0] not in self.clients_by_id:
+				continue
+			elif kind == workers.WORKER_MSG.INPUT:
+				client_id, key, state = args
+				self.clients_by_id[client_id].player.set_input(key, state)
+			elif kind == workers.WORKER_MSG.ACK:
+				client_id, snapshot_id = args
+				client = self.clients_by_id[client_id]
+				client.acked_snapshot = max(client.acked_snapshot, snapshot_id)
+			elif kind == workers.WORKER_MSG.LOGOUT:
+				client = self.clients_by_id.pop(args[0])
+				client.player.solar_system.remove_player(client.player)
+
+	def run(self):
+		self.scheduler = scheduler.TickScheduler(max_catch_up=MAX_CATCH_UP_FRAMES, stats=self.stats)
+		self.scheduler.add_task('physics', FRAME_RATE, self.update_systems, catch_up=True)
+		# snapshots go out at their own rate, independent of the physics
+		self.scheduler.add_task('snapshots', self.snapshot_rate, self.send_frames)
+		self.scheduler.add_task('database', DATABASE_FRAME_RATE, self.update_database)
+		self.scheduler.add_task('report', SCHEDULER_REPORT_RATE, self.report_ticks)
+		if self.stats.enabled and self.stats_file is not None:
+			self.scheduler.add_task('stats', STATS_DUMP_RATE, self.dump_stats)
+		if self.stats.enabled and self.stats_port is not None:
+			gevent.spawn(self.stats.serve, self.stats_port)
+		self.scheduler.run()
+
+	def update_systems(self, delta):
+		self.sim_time += delta
+		# players moving systems can wake others mid-update, they start next tick
+		for solar_system in self.active_systems.values():
+			with self.stats.timer(solar_system.update_stat):
+				solar_system.update(delta)
+		# put systems with nothing left in them to sleep
+		for solar_system in [system for system in self.active_systems.itervalues() if system.is_empty()]:
+			solar_system.dormant = True
+			del self.active_systems[solar_system.id]
+		self.stats.record('systems.active', len(self.active_systems), stats.COUNT_BOUNDS)
+		self.stats.record('systems.dormant', len(self.solar_systems) - len(self.active_systems), 
+						  stats.COUNT_BOUNDS)
+
+	def send_frames(self, delta):
+		now = time.time()
+		for solar_system in self.active_systems.itervalues():
+			self.stats.record(solar_system.players_stat, len(solar_system.players), 
+							  stats.COUNT_BOUNDS)
+			with self.stats.timer('frame.total'):
+				solar_system.send_frame(now)
+
+	def update_database(self, delta):
+		with self.stats.timer('database.flush'):
+			dirty_players = []
+			for solar_system in self.solar_systems:
+				dirty_players.extend(solar_system.get_updates_for_db())
+			if dirty_players:
+				self.database_sock.send_message(MSG.DB_QUERY, 
+												[DBQUERY.GS_UPDATE, dirty_players])
+		self.stats.count('database.rows', len(dirty_players))
+
+	def dump_stats(self, delta):
+		self.stats.dump(self.stats_file)
+
+	def report_ticks(self, delta):
+		"""Print any tasks that overran or dropped ticks, and the number of
+		active and dormant systems, if they changed since the last report.
+
+		"""
+		for name, runs, overruns, skipped in self.scheduler.report():
+			if (overruns, skipped) != self.reported_ticks.get(name, (0, 0)):
+				print "Task %s: %i runs, %i overran, %i skipped" % (name, runs, overruns, skipped)
+				self.reported_ticks[name] = (overruns, skipped)
+		systems = (len(self.active_systems), len(self.solar_systems) - len(self.active_systems))
+		if systems != self.reported_systems:
+			print "Systems: %i active, %i dormant" % systems
+			self.reported_systems = systems
+
+	def next_snapshot_id(self):
+		"""Snapshot ids are unique across all systems on this server, so a late
+		acknowledgement from a player's previous system is never mistaken for
+		one from their current system.
+
+		"""
+		self.snapshot_id_counter += self.snapshot_id_step
+		return self.snapshot_id_counter
 
 	def build_systems(self, data):
 		solar_system_data, edge_system_data, wormhole_data, planet_data, player_data = data
@@ -619,7 +1272,11 @@ class Manager:
 		if edge_system_data and edge_system_data != [None]:
 			edge_systems = []
 			for s_id, s_name in edge_system_data:
-				system = RemoteSolarSystem(s_id, s_name, self.servers_by_system[s_id], self)
+				if self.channel is not None:
+					# a worker has no server connections, the main process passes players on
+					system = workers.ProxySolarSystem(self, s_id, s_name)
+				else:
+					system = RemoteSolarSystem(s_id, s_name, self.servers_by_system[s_id], self)
 				self.systems_by_id[s_id] = system
 				edge_systems.append(system)
 		else:
@@ -650,11 +1307,14 @@ class Manager:
 		for w_id, wormhole in wormholes_by_id.iteritems():
 			for mouth in wormhole:
 				mouth.origin.add_wormhole(mouth)
+		for system in self.solar_systems:
+			system.arrival_mouths = {mouth.destination.id: mouth for mouth in system.wormhole_mouths 
+									 if mouth.destination is not None}
 		# player data
 		if player_data and player_data != [None]:
-			self.players = [OfflinePlayer(p_id, p_name, p_x, p_y, self.systems_by_id[p_system])
-					   		for p_id, p_name, p_x, p_y, p_system in player_data]
-			self.players_by_id = {player.id: player for player in self.players}
+			self.players = collections.OrderedDict(
+				(p_id, OfflinePlayer(p_id, p_name, p_x, p_y, self.systems_by_id[p_system]))
+				for p_id, p_name, p_x, p_y, p_system in player_data)
 
 	def send_map_info(self, solar_system, player):
 		"""Send a YAML dump of the data for a solar system to a player.
@@ -662,6 +1322,7 @@ class Manager:
 		solar_system 	LocalSolarSystem object to pull data from
 		player 			Player object to send through
 		"""
+		solar_system.evaluate_orbits() # so the degrees sent are current
 		data = {'id': solar_system.id, 
 				'name': solar_system.name, 
 				'size': solar_system.size,
@@ -682,7 +1343,9 @@ class Manager:
 							  for wormhole in solar_system.wormhole_mouths],
 				'players': [{'id': other_player.id,
 							 'name': other_player.name}
-							for other_player in solar_system.players]
+							for other_player in solar_system.players],
+				'quantization': (solar_system.quantizer.parameters() 
+								 if solar_system.quantizer is not None else None)
 			   }
 		player.client.socket.send_message(MSG.GW_CL_SYSTEM_INFO, yaml.dump(data))
 
@@ -696,7 +1359,13 @@ parser.add_argument('client', metavar='client', type=int,
 	help='Port for clients to connect on')
 parser.add_argument('server', metavar='server', type=int, 
 	help='Port for servers to connect on')
+parser.add_argument('--workers', type=int, default=0, 
+	help='Number of worker processes to run the solar systems in (0 runs them in this process)')
+parser.add_argument('--stats-file', default=None, 
+	help='File to dump stats to periodically (suffixed with the worker number in workers)')
+parser.add_argument('--stats-port', type=int, default=None, 
+	help='Local port to serve stats on (workers use the ports following it)')
 args = parser.parse_args()
 
-manager = Manager()
+manager = Manager(args.workers, args.stats_file, args.stats_port)
 manager.begin(args.client, args.server)
\ No newline at end of file
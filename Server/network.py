@@ -3,6 +3,8 @@ from gevent import socket
 
 import time
 import math
+import struct
+import collections
 
 import config
 from utility import enum
@@ -66,6 +68,8 @@ def parse_data(string, level=0):
 def package_data(data, level=0):
 	if data is None:
 		return "n"
+	if isinstance(data, Encoded):
+		return data.text(level)
 	if isinstance(data, (list, tuple)):		
 			out = "l" if isinstance(data, list) else "t"
 			for i in range(len(data)):
@@ -83,35 +87,421 @@ def package_data(data, level=0):
 		return "s" + data
 	else:
 		raise TypeError("Can't package: \"" + str(data) + "\" - can only package lists, tuples, ints, floats, and strings.")
-	
+
+"""
+Binary codec
+"""
+# every value is a one character type tag followed by its packed payload
+INT8 = struct.Struct('!b')
+INT16 = struct.Struct('!h')
+INT32 = struct.Struct('!i')
+INT64 = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+SHORT_LENGTH = struct.Struct('!H')
+LENGTH = struct.Struct('!I')
+BINARY_HEADER = struct.Struct('!dIH') # time, id, type
+BINARY_PREFIX_SIZE = len(config.MSG_BINARY_CHAR) + LENGTH.size
+BINARY_CHAR_CODE = ord(config.MSG_BINARY_CHAR)
+
+def pack_data(data):
+	"""Packs data into a binary string. Supports the same types as
+	package_data, but uses fixed-size structs for numbers and length
+	prefixes for lists and strings instead of delimiters.
+
+	"""
+	out = []
+	_pack_into(data, out)
+	return "".join(out)
+
+def _pack_into(data, out):
+	if data is None:
+		out.append("n")
+	elif isinstance(data, Encoded):
+		out.append(data.binary())
+	elif isinstance(data, (list, tuple)):
+		length = len(data)
+		if length <= 0xFFFF:
+			out.append(("l" if isinstance(data, list) else "t") + SHORT_LENGTH.pack(length))
+		else:
+			out.append(("L" if isinstance(data, list) else "T") + LENGTH.pack(length))
+		for item in data:
+			_pack_into(item, out)
+	elif isinstance(data, (int, long)):
+		if -0x80 <= data < 0x80:
+			out.append("b" + INT8.pack(data))
+		elif -0x8000 <= data < 0x8000:
+			out.append("h" + INT16.pack(data))
+		elif -0x80000000 <= data < 0x80000000:
+			out.append("i" + INT32.pack(data))
+		else:
+			out.append("q" + INT64.pack(data))
+	elif isinstance(data, float):
+		out.append("f" + FLOAT.pack(data))
+	elif isinstance(data, basestring):
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+		out.append("s" + LENGTH.pack(len(data)) + data)
+	else:
+		raise TypeError("Can't pack: \"" + str(data) + "\" - can only pack lists, tuples, ints, floats, and strings.")
+
+def unpack_data(string, offset=0):
+	"""Unpacks a value packed by pack_data, starting at offset. Returns the
+	value and the offset of the first byte after it.
+
+	"""
+	tag = string[offset]
+	offset += 1
+	if tag == "b":
+		return INT8.unpack_from(string, offset)[0], offset+INT8.size
+	elif tag == "h":
+		return INT16.unpack_from(string, offset)[0], offset+INT16.size
+	elif tag == "i":
+		return INT32.unpack_from(string, offset)[0], offset+INT32.size
+	elif tag == "q":
+		return INT64.unpack_from(string, offset)[0], offset+INT64.size
+	elif tag == "f":
+		return FLOAT.unpack_from(string, offset)[0], offset+FLOAT.size
+	elif tag in "ltLT":
+		if tag in "lt":
+			length = SHORT_LENGTH.unpack_from(string, offset)[0]
+			offset += SHORT_LENGTH.size
+		else:
+			length = LENGTH.unpack_from(string, offset)[0]
+			offset += LENGTH.size
+		out = []
+		for i in xrange(length):
+			value, offset = unpack_data(string, offset)
+			out.append(value)
+		return (out if tag in "lL" else tuple(out)), offset
+	elif tag == "s":
+		length = LENGTH.unpack_from(string, offset)[0]
+		offset += LENGTH.size
+		return string[offset:offset+length], offset+length
+	elif tag == "n":
+		return None, offset
+	raise ValueError("Can't unpack: unknown type tag " + repr(tag))
+
+
+class Encoded:
+	"""Wraps a value so that it's encoded at most once per codec (and, for
+	the text codec, per nesting level) however many messages it's part of.
+	Both codecs splice the cached encoding in where the value appears.
+
+	"""
+	def __init__(self, value):
+		self.value = value
+		self.encodings = {}
+
+	def text(self, level):
+		encoding = self.encodings.get(level)
+		if encoding is None:
+			encoding = self.encodings[level] = package_data(self.value, level)
+		return encoding
+
+	def binary(self):
+		encoding = self.encodings.get('binary')
+		if encoding is None:
+			encoding = self.encodings['binary'] = pack_data(self.value)
+		return encoding
+
+
+def package_body(data, codec=config.CODEC.TEXT):
+	"""Encodes the data of a message on its own, ready to be combined with a
+	header by package_message.
+
+	"""
+	if codec == config.CODEC.BINARY:
+		return pack_data(data)
+	return package_data(data, 1)
+
+def package_message(msg_time, msg_id, msg_type, body, codec=config.CODEC.TEXT):
+	"""Builds a complete framed message from its header fields and a body
+	encoded by package_body with the same codec.
+
+	"""
+	if codec == config.CODEC.BINARY:
+		header = BINARY_HEADER.pack(msg_time, msg_id, msg_type)
+		return (config.MSG_BINARY_CHAR + LENGTH.pack(len(header)+len(body)) 
+				+ header + body)
+	# equivalent to package_data([msg_time, msg_id, msg_type, data])
+	delimiter = chr(config.MSG_TOP_DELIMITER)
+	return ("l" + package_data(msg_time, 1) + delimiter 
+			+ package_data(msg_id, 1) + delimiter 
+			+ package_data(msg_type, 1) + delimiter 
+			+ body + config.MSG_END_CHAR)
+
+
+"""
+Snapshot deltas
+"""
+def delta_row(row_id, row, old=None):
+	"""Compares a row, a list of fields, against its older value. Returns
+	[id, mask, fields...] with bit i of mask set if field i is included, or
+	None if the row hasn't changed. If old is None the row is included in
+	full.
+
+	"""
+	if old is None:
+		return [row_id, (1 << len(row)) - 1] + row
+	if old == row:
+		return None
+	entry = [row_id, 0]
+	for i in xrange(len(row)):
+		if row[i] != old[i]:
+			entry[1] |= 1 << i
+			entry.append(row[i])
+	return entry
+
+class DeltaEncoder:
+	"""Works out frame deltas for many baselines against rows from the same
+	frame, with each changed entry worked out and encoded only once. Entries
+	are keyed by the identity of the new and old row, which is shared by
+	every socket that was sent the same row object, so sockets that are
+	roughly in step share most of their entries.
+
+	"""
+	def __init__(self):
+		self.entries = {} # (id(row), id(old row)): (row, old row, Encoded entry or None)
+
+	def delta_rows(self, rows, baseline=None):
+		"""Compares rows, a dict of {id: list of fields}, against an older dict
+		of the same form. Returns the delta_row entries, as shared Encoded
+		values, for every row that is new or has changed, and a list of the
+		ids in baseline that are no longer in rows.
+
+		"""
+		changed = []
+		for row_id, row in rows.iteritems():
+			old = baseline.get(row_id) if baseline else None
+			if old is row:
+				continue
+			key = (id(row), id(old))
+			cached = self.entries.get(key)
+			if cached is None:
+				entry = delta_row(row_id, row, old)
+				# the rows are kept so their ids can't be reused while cached
+				cached = self.entries[key] = (row, old, 
+											  Encoded(entry) if entry is not None else None)
+			if cached[2] is not None:
+				changed.append(cached[2])
+		removed = [row_id for row_id in baseline if row_id not in rows] if baseline else []
+		return changed, removed
+
+
+class Quantizer:
+	"""Converts frame positions and angles to fixed-point ints and back.
+	position_scale is the distance in world units between two adjacent
+	encoded positions, and positions are clamped to what fits in
+	position_bits signed bits. Angles are encoded as one of angle_steps
+	steps per full turn.
+
+	"""
+	def __init__(self, position_scale, angle_steps, position_bits=16):
+		self.position_scale = float(position_scale)
+		self.position_limit = (1 << (position_bits-1)) - 1
+		self.angle_steps = angle_steps
+		self.angle_scale = config.MAX_RAD / angle_steps
+		self.position_bits = position_bits
+
+	def position(self, value):
+		encoded = int(round(value / self.position_scale))
+		return max(-self.position_limit, min(self.position_limit, encoded))
+
+	def angle(self, value):
+		return int(round(value / self.angle_scale)) % self.angle_steps
+
+	def unposition(self, encoded):
+		return encoded * self.position_scale
+
+	def unangle(self, encoded):
+		return encoded * self.angle_scale
+
+	def parameters(self):
+		"""Keyword arguments that recreate this quantizer on the other end."""
+		return {'position_scale': self.position_scale, 
+				'angle_steps': self.angle_steps, 
+				'position_bits': self.position_bits}
+
+
+class MessageBuffer:
+	"""Receive buffer that splits a byte stream into messages. Bytes are read
+	straight into a reusable bytearray with recv_into, and every message
+	completed by a read is decoded and queued in one go. The search for
+	MSG_END_CHAR resumes from where the previous search stopped, so no byte
+	is inspected more than once.
+
+	"""
+	def __init__(self, size=config.SOCKET_RECV_MAX_BYTES):
+		self.data = bytearray(size*2)
+		self.start = 0 # first byte of the oldest incomplete message
+		self.end = 0 # one past the last received byte
+		self.scan_pos = 0 # first byte not yet searched for MSG_END_CHAR
+		self.messages = collections.deque()
+		self.received = 0 # total bytes read
+
+	def receive(self, sock, size=config.SOCKET_RECV_MAX_BYTES):
+		"""Reads up to size bytes from sock and queues any messages they
+		complete. Returns the number of bytes read, 0 meaning the connection
+		was closed.
+
+		"""
+		self.reserve(size)
+		count = sock.recv_into(memoryview(self.data)[self.end:], size)
+		self.end += count
+		self.received += count
+		self.extract()
+		return count
+
+	def reserve(self, size):
+		"""Makes room for size more bytes after end, first by moving the
+		incomplete message to the front and then by growing the buffer.
+
+		"""
+		if len(self.data) - self.end >= size:
+			return
+		if self.start > 0:
+			pending = self.end - self.start
+			self.data[:pending] = self.data[self.start:self.end]
+			self.scan_pos -= self.start
+			self.start, self.end = 0, pending
+		while len(self.data) - self.end < size:
+			self.data.extend(bytearray(len(self.data)))
+
+	def extract(self):
+		data = self.data
+		while self.start < self.end:
+			if data[self.start] == BINARY_CHAR_CODE:
+				# binary messages are length-prefixed rather than terminated
+				if self.end - self.start < BINARY_PREFIX_SIZE:
+					break
+				body = self.start + BINARY_PREFIX_SIZE
+				stop = body + LENGTH.unpack_from(data, self.start+1)[0]
+				if stop > self.end:
+					break
+				self.messages.append(Message.from_string(str(data[body:stop]), 
+														 config.CODEC.BINARY))
+				self.start = self.scan_pos = stop
+			else:
+				stop = data.find(config.MSG_END_CHAR, max(self.start, self.scan_pos), self.end)
+				if stop == -1:
+					self.scan_pos = self.end
+					break
+				self.messages.append(Message.from_string(str(data[self.start:stop])))
+				self.start = self.scan_pos = stop+1
+		if self.start == self.end:
+			self.start = self.end = self.scan_pos = 0
+
+
+class PendingMessages:
+	"""Messages put aside by Socket.wait_for_message while it waits for a
+	different type. Each message type has its own FIFO queue, so finding and
+	removing the oldest message of a type is O(1). At most max_size messages
+	are kept; past that, the oldest message of any type is dropped and
+	counted in evicted.
+
+	"""
+	def __init__(self, max_size=config.SOCKET_MAX_PENDING_MESSAGES):
+		self.max_size = max_size
+		self.by_type = {} # type: deque of (sequence, message)
+		self.order = collections.deque() # (sequence, type) in arrival order
+		self.sequence = 0
+		self.count = 0
+		self.evicted = 0
+
+	def __len__(self):
+		return self.count
+
+	def push(self, msg):
+		queue = self.by_type.get(msg.type)
+		if queue is None:
+			queue = self.by_type[msg.type] = collections.deque()
+		queue.append((self.sequence, msg))
+		self.order.append((self.sequence, msg.type))
+		self.sequence += 1
+		self.count += 1
+		if self.count > self.max_size:
+			self.pop()
+			self.evicted += 1
+		elif len(self.order) > self.max_size*2:
+			# drop the order entries of messages already popped by type
+			self.order = collections.deque(entry for entry in self.order 
+										   if self.is_pending(*entry))
+
+	def is_pending(self, sequence, msg_type):
+		# queues are only ever popped from the front, so anything at or
+		# after the head of its queue is still waiting
+		queue = self.by_type.get(msg_type)
+		return queue is not None and queue[0][0] <= sequence
+
+	def pop(self, msg_type=None):
+		"""Remove and return the oldest message of the given type, or of any
+		of the given types if msg_type is a list or tuple, or of any type if
+		it is None. Returns None if there is no such message.
+
+		"""
+		if msg_type is None:
+			while self.order:
+				sequence, msg_type = self.order.popleft()
+				if self.is_pending(sequence, msg_type):
+					return self.pop_type(msg_type)
+			return None
+		if isinstance(msg_type, (list, tuple)):
+			oldest = None
+			for t in msg_type:
+				queue = self.by_type.get(t)
+				if queue and (oldest is None or queue[0][0] < self.by_type[oldest][0][0]):
+					oldest = t
+			return self.pop_type(oldest) if oldest is not None else None
+		return self.pop_type(msg_type) if msg_type in self.by_type else None
+
+	def pop_type(self, msg_type):
+		queue = self.by_type[msg_type]
+		msg = queue.popleft()[1]
+		if not queue:
+			del self.by_type[msg_type]
+		self.count -= 1
+		return msg
+
 
 class Socket:
-	def __init__(self, sock=None, address=None):
+	"""Wraps a socket with message framing. Messages are sent using the
+	socket's codec (config.MSG_CODEC unless one is given), but either codec
+	is accepted when receiving, so peers using different codecs can still
+	talk to each other as long as each can decode what the other sends.
+
+	"""
+	def __init__(self, sock=None, address=None, codec=None):
 		self.socket = socket.socket() if sock is None else sock
 		self.address = address
+		self.codec = config.MSG_CODEC if codec is None else codec
 		self.msg_id_counter = 0
 		self.start_time = time.time()
-		self.ignored_messages = []
-		self.leftover = ""
+		self.ignored_messages = PendingMessages()
+		self.buffer = MessageBuffer()
 
 	def send_message(self, msg_type, data=None):
 		msg_time = round((time.time()-self.start_time), config.MSG_TIME_ACCURACY)
-		msg = Message(time=msg_time, msg_id=self.msg_id_counter, 
+		msg = Message(time=msg_time, msg_id=self.msg_id_counter,
 					  msg_type=msg_type, data=data)
 		self.msg_id_counter += 1
-		self.socket.send(msg.package())
+		self.socket.send(msg.package(self.codec))
 		return msg
 
+	def send_body(self, msg_type, body):
+		"""Send a message whose data is already encoded by package_body with
+		this socket's codec.
+
+		"""
+		msg_time = round((time.time()-self.start_time), config.MSG_TIME_ACCURACY)
+		self.socket.send(package_message(msg_time, self.msg_id_counter, msg_type, 
+										 body, self.codec))
+		self.msg_id_counter += 1
+
 	def check_ignored_messages(self, msg_type=None):
-		try:
-			return (msg for msg in self.ignored_messages 
-					if msg_type is None 
-					or msg.type == msg_type).next()
-		except StopIteration:
-			return None
+		return self.ignored_messages.pop(msg_type)
 
 	def ignore_message(self, msg):
-		self.ignored_messages.append(msg)
+		self.ignored_messages.push(msg)
 
 	def wait_for_message(self, msg_type=None):
 		msg = self.check_ignored_messages(msg_type)
@@ -129,15 +519,13 @@ class Socket:
 			self.ignore_message(msg)
 
 	def get_next_message(self):
-		data = self.leftover
-		while data.find(config.MSG_END_CHAR) == -1:
+		while not self.buffer.messages:
 			try:
-				data += self.socket.recv(config.SOCKET_RECV_MAX_BYTES)
+				if self.buffer.receive(self.socket) == 0:
+					return None
 			except IOError:
 				return None
-		self.leftover = data[data.find(config.MSG_END_CHAR)+1:]		
-		data = data[:-(len(self.leftover)+1)]
-		return Message.from_string(data)
+		return self.buffer.messages.popleft()
 
 	def connect(self, address):
 		self.address = address
@@ -151,7 +539,7 @@ class Socket:
 
 	def accept(self):
 		sock, address = self.socket.accept()
-		return Socket(sock=sock, address=address), address
+		return Socket(sock=sock, address=address, codec=self.codec), address
 
 	def recv(self):
 		try:
@@ -176,15 +564,20 @@ class Message:
 		self.packaged = None
 
 	@classmethod
-	def from_string(cls, string):
+	def from_string(cls, string, codec=config.CODEC.TEXT):
 		msg = Message()
-		parsed = parse_data(string)
-		msg.time, msg.id, msg.type, msg.data = parsed
+		if codec == config.CODEC.BINARY:
+			msg.time, msg.id, msg.type = BINARY_HEADER.unpack_from(string)
+			msg.data = unpack_data(string, BINARY_HEADER.size)[0]
+		else:
+			parsed = parse_data(string)
+			msg.time, msg.id, msg.type, msg.data = parsed
 		msg.packaged = string
 		return msg
 
-	def package(self):
+	def package(self, codec=config.CODEC.TEXT):
 		if self.time is None:
 			self.time = time.time()
-		self.packaged = package_data([self.time, self.id, self.type, self.data]) + config.MSG_END_CHAR
+		self.packaged = package_message(self.time, self.id, self.type, 
+										package_body(self.data, codec), codec)
 		return self.packaged
\ No newline at end of file
@@ -0,0 +1,97 @@
+import time
+
+import gevent
+
+class Task:
+	"""A callback run by a TickScheduler every interval seconds."""
+	def __init__(self, name, interval, callback, catch_up=False):
+		self.name = name
+		self.interval = interval
+		self.callback = callback
+		self.catch_up = catch_up
+		self.next_run = None
+		self.last_run = None
+		self.runs = 0
+		self.overruns = 0 # runs that took longer than the interval
+		self.skipped = 0 # ticks dropped because the scheduler fell behind
+		self.stat_names = ('task.%s' % name, 'task.%s.overruns' % name, 'task.%s.skipped' % name)
+
+
+class TickScheduler:
+	"""Runs tasks at fixed intervals, sleeping until the next deadline
+	instead of polling the clock.
+
+	Tasks added with catch_up=True are fixed-timestep: the callback is
+	always given the interval as its delta, and if the scheduler falls
+	behind it is called repeatedly to catch up, at most max_catch_up times
+	per pass. Any backlog beyond that is dropped and counted as skipped, so
+	a slow tick can't make every following tick slower. Other tasks run
+	once per deadline with the real time since their last run, and missed
+	deadlines are skipped.
+
+	If given a stats.Stats, task run times, overruns and skipped ticks are
+	recorded into it.
+
+	"""
+	def __init__(self, max_catch_up=5, clock=time.time, sleep=gevent.sleep, stats=None):
+		self.max_catch_up = max_catch_up
+		self.clock = clock
+		self.sleep = sleep
+		self.stats = stats
+		self.tasks = [] # run in the order they were added
+		self.tasks_by_name = {}
+
+	def add_task(self, name, interval, callback, catch_up=False):
+		task = Task(name, interval, callback, catch_up)
+		self.tasks.append(task)
+		self.tasks_by_name[name] = task
+		return task
+
+	def run(self):
+		now = self.clock()
+		for task in self.tasks:
+			task.last_run = now
+			task.next_run = now + task.interval
+		while True:
+			self.run_due(self.clock())
+			deadline = min(task.next_run for task in self.tasks)
+			self.sleep(max(0, deadline - self.clock()))
+
+	def run_due(self, now):
+		for task in self.tasks:
+			if now < task.next_run:
+				continue
+			if task.catch_up:
+				steps = 0
+				while task.next_run <= now and steps < self.max_catch_up:
+					self.execute(task, task.interval)
+					task.next_run += task.interval
+					steps += 1
+			else:
+				self.execute(task, now - task.last_run)
+				task.next_run += task.interval
+			if task.next_run <= now:
+				# too far behind, drop the backlog rather than spiral
+				missed = int((now - task.next_run) / task.interval) + 1
+				task.skipped += missed
+				task.next_run += missed * task.interval
+				if self.stats is not None:
+					self.stats.count(task.stat_names[2], missed)
+
+	def execute(self, task, delta):
+		start = self.clock()
+		task.callback(delta)
+		task.last_run = start
+		task.runs += 1
+		duration = self.clock() - start
+		if duration > task.interval:
+			task.overruns += 1
+		if self.stats is not None:
+			self.stats.record(task.stat_names[0], duration)
+			if duration > task.interval:
+				self.stats.count(task.stat_names[1])
+
+	def report(self):
+		"""Return (name, runs, overruns, skipped) for each task."""
+		return [(task.name, task.runs, task.overruns, task.skipped)
+				for task in self.tasks]
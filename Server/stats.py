@@ -0,0 +1,139 @@
+import os
+import time
+import bisect
+import collections
+
+import yaml
+import gevent
+
+import network
+import config
+
+# bucket upper bounds for durations in seconds, 10us doubling up to ~10s
+TIME_BOUNDS = [0.00001 * 2**i for i in xrange(21)]
+# bucket upper bounds for counts, e.g. players in a system
+COUNT_BOUNDS = [0] + [2**i for i in xrange(16)]
+
+class Histogram:
+	"""Counts values into fixed buckets, so recording is cheap and the
+	memory used doesn't grow. Percentiles are given as the upper bound of
+	the bucket they fall in.
+
+	"""
+	def __init__(self, bounds=TIME_BOUNDS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds)+1) # the last bucket is for anything larger
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, fraction):
+		target = fraction * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= target:
+				return self.bounds[i] if i < len(self.bounds) else self.max
+		return 0
+
+	def summary(self):
+		return {'count': self.count,
+				'mean': float(self.total) / self.count if self.count else 0,
+				'max': self.max,
+				'p50': self.percentile(0.5),
+				'p90': self.percentile(0.9),
+				'p99': self.percentile(0.99)}
+
+
+class Timer:
+	"""Context manager recording how long its block took into a histogram."""
+	def __init__(self, histogram):
+		self.histogram = histogram
+		self.start = None
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.histogram.add(time.time() - self.start)
+		return False
+
+
+class NullTimer:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+NULL_TIMER = NullTimer()
+
+class Stats:
+	"""A named set of histograms and counters. When disabled, recording does
+	nothing and timers are a shared no-op, so instrumented code costs next
+	to nothing.
+
+	"""
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.started = time.time()
+		self.histograms = collections.OrderedDict()
+		self.counters = collections.OrderedDict()
+
+	def histogram(self, name, bounds=TIME_BOUNDS):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram(bounds)
+		return histogram
+
+	def record(self, name, value, bounds=TIME_BOUNDS):
+		if self.enabled:
+			self.histogram(name, bounds).add(value)
+
+	def count(self, name, amount=1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def timer(self, name):
+		if not self.enabled:
+			return NULL_TIMER
+		return Timer(self.histogram(name))
+
+	def report(self):
+		"""Return everything recorded so far as plain data."""
+		return {'uptime': time.time() - self.started,
+				'histograms': {name: histogram.summary()
+							   for name, histogram in self.histograms.iteritems()},
+				'counters': dict(self.counters)}
+
+	def dump(self, path):
+		"""Write the report to a YAML file, replacing it in one go so readers
+		never see half a file.
+
+		"""
+		temp_path = path + '.tmp'
+		with open(temp_path, 'w') as f:
+			f.write(yaml.dump(self.report()))
+		os.rename(temp_path, path)
+
+	def serve(self, port):
+		"""Send a YAML dump of the report to anything connecting to port on
+		localhost, then close the connection.
+
+		"""
+		server_sock = network.Socket()
+		server_sock.bind(('127.0.0.1', port))
+		server_sock.listen(config.SOCKET_CLIENT_MAX_QUEUE)
+		print "Serving stats on port %i" % port
+		while True:
+			sock, address = server_sock.accept()
+			sock.socket.sendall(yaml.dump(self.report()))
+			sock.close()
@@ -1,3 +1,5 @@
+import math
+
 def enum(*sequential, **named):
 	"""enum function taken from: http://stackoverflow.com/a/1695250"""
 	enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -39,4 +41,46 @@ class Rect:
 			return False
 		if self.top < other.bottom:
 			return False
-		return True
\ No newline at end of file
+		return True
+
+class SpatialHash:
+	"""Uniform grid broadphase. Each item is filed under every cell its rect
+	overlaps, so a query only has to look at items in the cells the query
+	rect overlaps. Items returned by query may not actually collide with
+	the rect; use query_colliding for that.
+
+	"""
+	def __init__(self, cell_size):
+		self.cell_size = float(cell_size)
+		self.cells = {}
+
+	def clear(self):
+		self.cells.clear()
+
+	def cell_range(self, rect):
+		return (int(math.floor(rect.left/self.cell_size)), 
+				int(math.floor(rect.bottom/self.cell_size)),
+				int(math.floor(rect.right/self.cell_size)), 
+				int(math.floor(rect.top/self.cell_size)))
+
+	def insert(self, item, rect):
+		left, bottom, right, top = self.cell_range(rect)
+		for x in xrange(left, right+1):
+			for y in xrange(bottom, top+1):
+				cell = self.cells.get((x, y))
+				if cell is None:
+					self.cells[(x, y)] = [item]
+				else:
+					cell.append(item)
+
+	def query(self, rect):
+		left, bottom, right, top = self.cell_range(rect)
+		found = {} # keyed by identity, as entities compare equal by id
+		for x in xrange(left, right+1):
+			for y in xrange(bottom, top+1):
+				for item in self.cells.get((x, y), ()):
+					found[id(item)] = item
+		return found.values()
+
+	def query_colliding(self, rect):
+		return [item for item in self.query(rect) if rect.collides_with(item.rect)]
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+Worker processes for running a gameserver's solar systems on more than one
+core. The main process keeps every socket and does all the routing, while
+each worker simulates a share of the local systems and talks to the main
+process through a pipe. Players' sockets and the systems a worker doesn't
+run are stood in for by proxies that send over the pipe instead.
+"""
+import multiprocessing
+
+import gevent
+from gevent.socket import wait_read
+
+import network
+from utility import enum
+
+# messages between the main process and its workers
+# main to worker: BUILD, JOIN, INPUT, ACK, LOGOUT
+# worker to main: SEND, CLOSE, TRANSFER
+WORKER_MSG = enum('BUILD', 'JOIN', 'INPUT', 'ACK', 'LOGOUT', 'SEND', 'CLOSE', 'TRANSFER')
+
+DATABASE = -1 # id a ProxySocket uses to address the main process' database socket
+
+class Channel:
+	"""One end of a pipe between the main process and a worker."""
+	def __init__(self, connection):
+		self.connection = connection
+
+	def send(self, kind, *args):
+		self.connection.send((kind, args))
+
+	def messages(self):
+		"""Yield (kind, args) for every message received, waiting on the pipe
+		without blocking other greenlets. Stops when the other end closes.
+
+		"""
+		while True:
+			wait_read(self.connection.fileno())
+			try:
+				while self.connection.poll():
+					yield self.connection.recv()
+			except EOFError:
+				return
+
+
+class ProxySocket:
+	"""Stands in for a network.Socket held by the main process. Message data
+	is encoded here, in the worker, and the main process only stamps the
+	header on before sending it.
+
+	"""
+	def __init__(self, channel, socket_id, codec):
+		self.channel = channel
+		self.id = socket_id
+		self.codec = codec
+
+	def send_message(self, msg_type, data=None):
+		self.channel.send(WORKER_MSG.SEND, self.id, msg_type, network.package_body(data, self.codec))
+
+	def send_body(self, msg_type, body):
+		self.channel.send(WORKER_MSG.SEND, self.id, msg_type, body)
+
+	def close(self):
+		self.channel.send(WORKER_MSG.CLOSE, self.id)
+
+
+class ProxySolarSystem:
+	"""Stands in, inside a worker, for a solar system run by another worker
+	or another server. Players sent to it are handed to the main process.
+
+	"""
+	def __init__(self, manager, id, name):
+		self.manager = manager # the worker's Manager
+		self.id = id
+		self.name = name
+
+	def receive_player(self, player, origin_system):
+		self.manager.clients_by_id.pop(player.client.id, None)
+		self.manager.channel.send(WORKER_MSG.TRANSFER, player.client.id, player.id, player.name,
+								  self.id, origin_system.id)
+
+
+def start_worker(target):
+	"""Fork a worker process running target(channel) and return the main
+	process' Channel to it. Workers should be started before any greenlets
+	or sockets exist, so the child doesn't inherit them.
+
+	"""
+	connection, child_connection = multiprocessing.Pipe()
+	process = multiprocessing.Process(target=run_worker, args=(target, child_connection))
+	process.daemon = True
+	process.start()
+	child_connection.close()
+	return Channel(connection)
+
+def run_worker(target, connection):
+	gevent.reinit()
+	target(Channel(connection))
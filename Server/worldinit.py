@@ -1,14 +1,24 @@
+import os
 import sqlite3
+import argparse
 
+import config
 from galaxygen import generate_galaxy
 
 """
 This is the start of the actual script which calls the generation function
 and commits the results to an sqlite3 database
 """
+parser = argparse.ArgumentParser(
+	description='Generate a galaxy into the database')
+parser.add_argument('--seed', type=int, default=None, 
+	help='Random seed, so the same galaxy can be generated again')
+parser.add_argument('--min-systems', type=int, default=60)
+parser.add_argument('--max-systems', type=int, default=200)
+args = parser.parse_args()
 
-systems = generate_galaxy(min_systems=			60, 
-						  max_systems=			200, 
+systems = generate_galaxy(min_systems=			args.min_systems, 
+						  max_systems=			args.max_systems, 
 						  min_connections=		1,
 			 			  max_connections=		3, 
 			 			  min_planets=			2, 
@@ -22,7 +32,7 @@ systems = generate_galaxy(min_systems=			60,
 			 			  max_planet_speed=		0.785, 
 			 			  min_wormhole_speed=	0.174,
 			 			  max_wormhole_speed=	0.349,
-			 			  seed=					None)
+			 			  seed=					args.seed)
 
 planet_count = 0
 
@@ -32,8 +42,13 @@ print planet_count
 print len(systems)
 
 # commit the generated galaxy to the database
-conn = sqlite3.connect('data.db')
+db_exists = os.path.exists(config.DATABASE_FILE)
+conn = sqlite3.connect(config.DATABASE_FILE)
 cursor = conn.cursor()
+if not db_exists:
+	# create the tables the same way the database server does
+	with open("res/database.sql", "r") as sqlfile:
+		cursor.executescript(sqlfile.read())
 
 for system in systems:	
 	# insert the solar systems